@@ -0,0 +1,108 @@
+"""Cold-start budget for production workers: import wsgi, which runs create_app.
+
+Each run is a fresh interpreter, as for a new gunicorn worker. Exits with
+status 1 when the median run is over --budget-ms, or when the entry point
+pulls in a module production workers should never load (admin, CLI and
+scraping dependencies), so it can gate CI:
+
+    python benchmarks/import_time.py --budget-ms 1200
+
+src/tests/test_import_time.py runs the same checks under pytest.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FORBIDDEN_MODULES = ("flask_admin", "get_mapdata", "requests", "boto3", "PIL")
+
+CHILD = """
+import json, sys, time
+started = time.perf_counter()
+import wsgi
+elapsed = (time.perf_counter() - started) * 1000
+print(json.dumps({"ms": elapsed, "modules": sorted(sys.modules)}))
+"""
+
+
+def run_once(env, importtime=False):
+    command = [sys.executable] + (["-X", "importtime"] if importtime else [])
+    result = subprocess.run(
+        command + ["-c", CHILD],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.splitlines()[-1]), result.stderr
+
+
+def production_env():
+    env = dict(os.environ)
+    env.setdefault("APP_SETTINGS", "src.config.ProductionConfig")
+    env.setdefault("FLASK_ENV", "production")
+    # create_app never connects, any url will do
+    env.setdefault("DATABASE_URL", "postgresql://localhost/import_time")
+    env.setdefault("PYTHONDONTWRITEBYTECODE", "1")
+    return env
+
+
+def forbidden_modules(modules):
+    """The FORBIDDEN_MODULES among `modules`, or with a submodule in it."""
+    return [
+        name
+        for name in FORBIDDEN_MODULES
+        if name in modules or any(module.startswith(name + ".") for module in modules)
+    ]
+
+
+def slowest_imports(importtime_log, top):
+    """(ms, module) of the imports that took longest themselves, not counting
+    their own imports. The entry point's own time is create_app."""
+    rows = []
+    for line in importtime_log.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        own, _, name = line.split(":", 1)[1].split("|")
+        if own.strip().isdigit():
+            rows.append((int(own) / 1000, name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--budget-ms", type=float, default=1200)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    env = production_env()
+    timings = [run_once(env)[0]["ms"] for _ in range(args.runs)]
+    result, importtime_log = run_once(env, importtime=True)
+    forbidden = forbidden_modules(result["modules"])
+    median = statistics.median(timings)
+
+    print(
+        json.dumps(
+            {
+                "median_ms": median,
+                "min_ms": min(timings),
+                "max_ms": max(timings),
+                "budget_ms": args.budget_ms,
+                "modules": len(result["modules"]),
+                "forbidden_modules": forbidden,
+                "slowest_imports_ms": slowest_imports(importtime_log, args.top),
+            },
+            indent=2,
+        )
+    )
+    if median > args.budget_ms or forbidden:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
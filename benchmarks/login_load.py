@@ -0,0 +1,91 @@
+"""Latency of GET /places while POST /users/login is under concurrent load.
+
+Run it against a seeded server, once on the commit before the bcrypt pool
+and once after, then compare the JSON it prints:
+
+    python benchmarks/login_load.py --base-url http://localhost:5004 \
+        --email test123@cornell.edu --password 1234
+"""
+import argparse
+import json
+import statistics
+import threading
+import time
+
+import requests
+
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    idx = min(len(samples) - 1, int(round(pct / 100 * (len(samples) - 1))))
+    return samples[idx]
+
+
+def login_worker(base_url, email, password, stop, statuses):
+    session = requests.Session()
+    while not stop.is_set():
+        r = session.post(
+            f"{base_url}/users/login", json={"email": email, "password": password}
+        )
+        statuses.append(r.status_code)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--base-url", default="http://localhost:5004")
+    parser.add_argument("--email", default="test123@cornell.edu")
+    parser.add_argument("--password", default="1234")
+    parser.add_argument("--login-concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=500)
+    args = parser.parse_args()
+
+    stop = threading.Event()
+    statuses = []
+    threads = [
+        threading.Thread(
+            target=login_worker,
+            args=(args.base_url, args.email, args.password, stop, statuses),
+            daemon=True,
+        )
+        for _ in range(args.login_concurrency)
+    ]
+    for t in threads:
+        t.start()
+
+    session = requests.Session()
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(args.requests):
+        t0 = time.perf_counter()
+        session.get(f"{args.base_url}/places").raise_for_status()
+        latencies.append((time.perf_counter() - t0) * 1000)
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    for t in threads:
+        t.join()
+
+    print(
+        json.dumps(
+            {
+                "places_requests": len(latencies),
+                "places_rps": len(latencies) / elapsed,
+                "places_ms": {
+                    "mean": statistics.mean(latencies),
+                    "p50": percentile(latencies, 50),
+                    "p95": percentile(latencies, 95),
+                    "p99": percentile(latencies, 99),
+                },
+                "logins": len(statuses),
+                "login_503": statuses.count(503),
+                "login_concurrency": args.login_concurrency,
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,466 @@
+"""Load benchmark for every route of the API, /metrics included.
+
+Covers the places, users and reviews namespaces, including the bbox, tile
+and search cache routes of the map.
+
+Point it at a server backed by a local PostGIS filled with
+`python manage.py generate_synthetic`, then compare runs between versions:
+
+    python benchmarks/run.py --base-url http://localhost:5004 --out before.json
+    python benchmarks/run.py --base-url http://localhost:5004 --compare before.json
+
+Each route is driven with --requests requests from --concurrency threads and
+reported as throughput plus p50/p95/p99 latency in milliseconds.
+"""
+import argparse
+import json
+import math
+import random
+import subprocess
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+CAMPUS = (42.4500, -76.4800)
+TYPES = ("Blue Light", "Bathroom", "Water")
+
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(pct / 100 * (len(samples) - 1))))]
+
+
+class Client:
+    """Per-thread requests session plus the fixtures the scenarios need."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self._local = threading.local()
+        self.password = "benchmark"
+        self.email = f"bench-{uuid.uuid4().hex[:8]}@example.edu"
+        self.post(
+            "/users/register",
+            json={
+                "email": self.email,
+                "username": self.email,
+                "password": self.password,
+            },
+        ).raise_for_status()
+        self.user = self.post(
+            "/users/login", json={"email": self.email, "password": self.password}
+        ).json()
+        self.auth = {"Authorization": f"Bearer {self.user['session_token']}"}
+        page = self.get("/places", params={"limit": 1000}).json()
+        self.place_ids = [p["id"] for p in page] or [1]
+
+    @property
+    def session(self):
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def request(self, method, path, **kwargs):
+        return self.session.request(method, self.base_url + path, **kwargs)
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def place_id(self):
+        return random.choice(self.place_ids)
+
+    def origin(self):
+        lat, lon = CAMPUS
+        return lat + random.uniform(-0.005, 0.005), lon + random.uniform(-0.005, 0.005)
+
+    def new_review(self):
+        r = self.post(
+            "/reviews",
+            json={"place_id": self.place_id(), "rating": 4, "text": "benchmark"},
+            headers=self.auth,
+        )
+        r.raise_for_status()
+        return r.json()["id"]
+
+
+def _search_params(c):
+    lat, lon = c.origin()
+    return {"lat": lat, "lon": lon, "m": 300, "k": 10}
+
+
+def _viewport_params(c):
+    lat, lon = c.origin()
+    return {
+        "south": lat - 0.003,
+        "west": lon - 0.004,
+        "north": lat + 0.003,
+        "east": lon + 0.004,
+    }
+
+
+def _tile_path(c, z):
+    # XYZ tile of a campus origin, see src/api/places/tiles.py
+    lat, lon = c.origin()
+    n = 2 ** z
+    x = int((lon + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return f"/places/tiles/{z}/{x}/{y}"
+
+
+def _batch_body(c):
+    queries = []
+    for _ in range(20):
+        lat, lon = c.origin()
+        queries.append({"lat": lat, "lon": lon, "types": "Water", "m": 300, "k": 5})
+    return {"queries": queries}
+
+
+def _new_user(c):
+    email = f"bench-{uuid.uuid4().hex}@example.edu"
+    return {"email": email, "username": email, "password": c.password}
+
+
+def _created_place_id(c):
+    r = c.post(
+        "/places",
+        json={
+            "name": f"bench-{uuid.uuid4().hex}",
+            "types": "Bench",
+            "lat": 0,
+            "lon": 0,
+        },
+    )
+    r.raise_for_status()
+    return r.json()["id"]
+
+
+# name -> (prepare, method, path, request kwargs); prepare(client) runs
+# untimed before each request and its result is passed to path and kwargs
+SCENARIOS = {
+    # places
+    "GET /places": (None, "GET", lambda c, _: "/places", None),
+    "GET /places?limit=100": (
+        None,
+        "GET",
+        lambda c, _: "/places",
+        lambda c, _: {"params": {"limit": 100}},
+    ),
+    "POST /places": (
+        None,
+        "POST",
+        lambda c, _: "/places",
+        lambda c, _: {
+            "json": {
+                "name": f"bench-{uuid.uuid4().hex}",
+                "types": "Bench",
+                "lat": 0,
+                "lon": 0,
+            }
+        },
+    ),
+    "GET /places/<id>": (
+        None,
+        "GET",
+        lambda c, _: f"/places/{c.place_id()}",
+        None,
+    ),
+    "PUT /places/<id>": (
+        _created_place_id,
+        "PUT",
+        lambda c, place_id: f"/places/{place_id}",
+        lambda c, _: {
+            "json": {
+                "name": f"bench-{uuid.uuid4().hex}",
+                "types": "Bench",
+                "lat": 0,
+                "lon": 0,
+            }
+        },
+    ),
+    "DELETE /places/<id>": (
+        _created_place_id,
+        "DELETE",
+        lambda c, place_id: f"/places/{place_id}",
+        None,
+    ),
+    "GET /places/<types>": (
+        None,
+        "GET",
+        lambda c, _: f"/places/{random.choice(TYPES)}",
+        lambda c, _: {"params": _search_params(c)},
+    ),
+    "POST /places/search/batch": (
+        None,
+        "POST",
+        lambda c, _: "/places/search/batch",
+        lambda c, _: {"json": _batch_body(c)},
+    ),
+    "GET /places/search/cache": (
+        None,
+        "GET",
+        lambda c, _: "/places/search/cache",
+        None,
+    ),
+    "GET /places/bbox": (
+        None,
+        "GET",
+        lambda c, _: "/places/bbox",
+        lambda c, _: {"params": _viewport_params(c)},
+    ),
+    "GET /places/tiles/<z>/<x>/<y> clustered": (
+        None,
+        "GET",
+        lambda c, _: _tile_path(c, 14),
+        None,
+    ),
+    "GET /places/tiles/<z>/<x>/<y>": (
+        None,
+        "GET",
+        lambda c, _: _tile_path(c, 17),
+        None,
+    ),
+    "GET /places/<types>/top": (
+        None,
+        "GET",
+        lambda c, _: f"/places/{random.choice(TYPES)}/top",
+        lambda c, _: {"params": {"k": 10, "min_reviews": 3}},
+    ),
+    "GET /places/rating/<id>": (
+        None,
+        "GET",
+        lambda c, _: f"/places/rating/{c.place_id()}",
+        None,
+    ),
+    "GET /places/ratings": (
+        None,
+        "GET",
+        lambda c, _: "/places/ratings",
+        lambda c, _: {
+            "params": {"ids": ",".join(str(c.place_id()) for _ in range(40))}
+        },
+    ),
+    # users
+    "GET /users": (
+        None,
+        "GET",
+        lambda c, _: "/users",
+        lambda c, _: {"headers": c.auth},
+    ),
+    "POST /users": (
+        None,
+        "POST",
+        lambda c, _: "/users",
+        lambda c, _: {"json": _new_user(c)},
+    ),
+    "GET /users/all?limit=100": (
+        None,
+        "GET",
+        lambda c, _: "/users/all",
+        lambda c, _: {"headers": c.auth, "params": {"limit": 100}},
+    ),
+    "POST /users/login": (
+        None,
+        "POST",
+        lambda c, _: "/users/login",
+        lambda c, _: {"json": {"email": c.email, "password": c.password}},
+    ),
+    "POST /users/register": (
+        None,
+        "POST",
+        lambda c, _: "/users/register",
+        lambda c, _: {"json": _new_user(c)},
+    ),
+    "POST /users/session": (
+        lambda c: c.post("/users/register", json=_new_user(c)).json()["update_token"],
+        "POST",
+        lambda c, _: "/users/session",
+        lambda c, update_token: {
+            "headers": {"Authorization": f"Bearer {update_token}"}
+        },
+    ),
+    "POST /users/favorites/<id>": (
+        None,
+        "POST",
+        lambda c, _: f"/users/favorites/{c.place_id()}",
+        lambda c, _: {"headers": c.auth},
+    ),
+    "DELETE /users/favorites/<id>": (
+        lambda c: c.post(
+            f"/users/favorites/{c.place_ids[0]}", headers=c.auth
+        ).status_code,
+        "DELETE",
+        lambda c, _: f"/users/favorites/{c.place_ids[0]}",
+        lambda c, _: {"headers": c.auth},
+    ),
+    "POST /users/favorites": (
+        None,
+        "POST",
+        lambda c, _: "/users/favorites",
+        lambda c, _: {"headers": c.auth},
+    ),
+    "PATCH /users/favorites": (
+        None,
+        "PATCH",
+        lambda c, _: "/users/favorites",
+        lambda c, _: {
+            "headers": c.auth,
+            "json": {
+                "add": [c.place_id() for _ in range(20)],
+                "remove": [c.place_id() for _ in range(20)],
+            },
+        },
+    ),
+    "PUT /users/favorites": (
+        None,
+        "PUT",
+        lambda c, _: "/users/favorites",
+        lambda c, _: {
+            "headers": c.auth,
+            "json": {"place_ids": [c.place_id() for _ in range(50)]},
+        },
+    ),
+    # reviews
+    "GET /reviews?place=<id>": (
+        None,
+        "GET",
+        lambda c, _: "/reviews",
+        lambda c, _: {"params": {"place": c.place_id()}},
+    ),
+    "GET /reviews?limit=100": (
+        None,
+        "GET",
+        lambda c, _: "/reviews",
+        lambda c, _: {"params": {"limit": 100}},
+    ),
+    "GET /reviews/search?q=cold water": (
+        None,
+        "GET",
+        lambda c, _: "/reviews/search",
+        lambda c, _: {"params": {"q": "cold water", "limit": 20}},
+    ),
+    "POST /reviews": (
+        None,
+        "POST",
+        lambda c, _: "/reviews",
+        lambda c, _: {
+            "headers": c.auth,
+            "json": {"place_id": c.place_id(), "rating": 3, "text": "benchmark"},
+        },
+    ),
+    "GET /reviews/<id>": (
+        Client.new_review,
+        "GET",
+        lambda c, review_id: f"/reviews/{review_id}",
+        None,
+    ),
+    "PUT /reviews/<id>": (
+        Client.new_review,
+        "PUT",
+        lambda c, review_id: f"/reviews/{review_id}",
+        lambda c, _: {"headers": c.auth, "json": {"rating": 5, "text": "updated"}},
+    ),
+    "DELETE /reviews/<id>": (
+        Client.new_review,
+        "DELETE",
+        lambda c, review_id: f"/reviews/{review_id}",
+        lambda c, _: {"headers": c.auth},
+    ),
+    # metrics
+    "GET /metrics": (None, "GET", lambda c, _: "/metrics", None),
+}
+
+
+def run_scenario(client, scenario, total, concurrency):
+    prepare, method, path, kwargs = scenario
+    latencies = []
+    errors = []
+
+    def one(_):
+        context = prepare(client) if prepare else None
+        request_kwargs = kwargs(client, context) if kwargs else {}
+        started = time.perf_counter()
+        r = client.request(method, path(client, context), **request_kwargs)
+        latencies.append((time.perf_counter() - started) * 1000)
+        if r.status_code >= 400:
+            errors.append(r.status_code)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(total)))
+    elapsed = time.perf_counter() - started
+
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "throughput_rps": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    print(f"{'route':40} {'p50':>16} {'p99':>16} {'rps':>16}")
+    for name, stats in new["routes"].items():
+        before = old["routes"].get(name)
+        if before is None:
+            continue
+        cells = []
+        for key in ("p50_ms", "p99_ms", "throughput_rps"):
+            cells.append(f"{before[key]:7.1f}->{stats[key]:7.1f}")
+        print(f"{name:40} " + " ".join(f"{cell:>16}" for cell in cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--base-url", default="http://localhost:5004")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--only", action="append", help="run only these routes")
+    parser.add_argument("--out", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of an earlier run")
+    args = parser.parse_args()
+
+    client = Client(args.base_url)
+    results = {
+        "revision": git_revision(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "routes": {},
+    }
+    for name, scenario in SCENARIOS.items():
+        if args.only and name not in args.only:
+            continue
+        results["routes"][name] = run_scenario(
+            client, scenario, args.requests, args.concurrency
+        )
+
+    output = json.dumps(results, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output)
+    print(output)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
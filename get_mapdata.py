@@ -1,5 +1,11 @@
-import requests
+import json
+import logging
+import os
 import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
 
 # location_types = [
 #     "Blue",
@@ -13,9 +19,26 @@ type_dict = {
     "Water": "Water",
 }
 
+LAYER_URL = (
+    "https://www.cornell.edu/about/maps/overlay-items.cfm?layer={ltype}&clearCache=1"
+)
+CACHE_DIR = os.getenv(
+    "MAPDATA_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".mapdata_cache"),
+)
+MAX_ATTEMPTS = 3
+BACKOFF_SECONDS = 0.5
+
+logger = logging.getLogger(__name__)
+
+
+class MapDataError(Exception):
+    pass
 
-def get_img_url(ltype):
-    img_idx = random.randint(0, 2)
+
+def get_img_url(ltype, seed=None):
+    # seeding with the place name keeps image urls stable across runs
+    img_idx = random.Random(seed).randint(0, 2) if seed else random.randint(0, 2)
     url_dict = {
         "Blue": f"https://cornell-places-assets.s3.amazonaws.com/bluelight{img_idx}.jpg",
         "AllGender": f"https://cornell-places-assets.s3.amazonaws.com/all_gender{img_idx}.jpg",
@@ -24,22 +47,71 @@ def get_img_url(ltype):
     return url_dict[ltype]
 
 
-def get_locationdata(ltype):
-    url = f"https://www.cornell.edu/about/maps/overlay-items.cfm?layer={ltype}&clearCache=1"
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def fetch_layer(ltype, cache_dir=CACHE_DIR):
+    """Returns the raw overlay json of one layer.
 
-    isvalid = False
-    cnt = 0
-    while isvalid is False and cnt < 3:
+    Responses are cached on disk per layer and revalidated with
+    If-None-Match/If-Modified-Since. Failed requests are retried with
+    exponential backoff; if every attempt fails the cached copy is used, and
+    MapDataError is raised when there is none."""
+    body_path = os.path.join(cache_dir, f"{ltype}.json")
+    meta_path = os.path.join(cache_dir, f"{ltype}.meta.json")
+    cached = _read_json(body_path)
+    meta = _read_json(meta_path) or {}
+
+    headers = {}
+    if cached is not None:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    last_error = None
+    for attempt in range(MAX_ATTEMPTS):
         try:
-            r = requests.get(url, timeout=5)
+            r = requests.get(LAYER_URL.format(ltype=ltype), headers=headers, timeout=5)
+            if r.status_code == 304 and cached is not None:
+                return cached
             r.raise_for_status()
-        except:
-            cnt += 1
-            isvalid = False
+            payload = r.json()
+        except (requests.RequestException, ValueError) as e:
+            last_error = e
+            if attempt + 1 < MAX_ATTEMPTS:
+                time.sleep(BACKOFF_SECONDS * 2 ** attempt)
         else:
-            isvalid = True
+            _write_json(body_path, payload)
+            _write_json(
+                meta_path,
+                {
+                    "etag": r.headers.get("ETag"),
+                    "last_modified": r.headers.get("Last-Modified"),
+                },
+            )
+            return payload
+
+    if cached is not None:
+        logger.warning("Using cached %s layer, fetch failed: %s", ltype, last_error)
+        return cached
+    raise MapDataError(f"Could not fetch {ltype} layer: {last_error}")
 
-    req = r.json()
+
+def parse_layer(ltype, req):
     dlist = req.get("items", [])
     res = []
     for data in dlist:
@@ -50,13 +122,36 @@ def get_locationdata(ltype):
             ndata["lon"] = data.get("Lng")
             ndata["name"] = name
             ndata["types"] = type_dict[ltype]
-            ndata["image_url"] = get_img_url(ltype)
+            ndata["image_url"] = get_img_url(ltype, seed=f"{ltype}:{name}")
             res.append(ndata)
     return res
 
 
-def get_mapdata():
-    output = []
-    for tp in type_dict.keys():
-        output.extend(get_locationdata(tp))
+def get_locationdata(ltype, cache_dir=CACHE_DIR):
+    return parse_layer(ltype, fetch_layer(ltype, cache_dir))
+
+
+def load_snapshot(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_snapshot(path, mdata):
+    with open(path, "w") as f:
+        json.dump(mdata, f, indent=2)
+
+
+def get_mapdata(snapshot=None, cache_dir=CACHE_DIR):
+    """All places of every layer. With `snapshot`, replays a file written by
+    save_snapshot instead of touching the network."""
+    if snapshot is not None:
+        return load_snapshot(snapshot)
+
+    with ThreadPoolExecutor(max_workers=len(type_dict)) as executor:
+        layers = executor.map(
+            lambda tp: get_locationdata(tp, cache_dir), type_dict.keys()
+        )
+        output = []
+        for layer in layers:
+            output.extend(layer)
     return output
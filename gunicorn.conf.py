@@ -0,0 +1,35 @@
+import os
+import shutil
+
+# Workers write their metrics here, so /metrics can add them all up (see
+# src/metrics.py). Must be set before prometheus_client is imported.
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus_multiproc")
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv("GUNICORN_WORKERS", "2"))
+# "sync" or "gevent"; gevent serves up to worker_connections requests per
+# worker concurrently, which suits our mostly-waiting-on-Postgres endpoints
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "sync")
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "100"))
+
+
+def post_fork(server, worker):
+    if worker_class == "gevent":
+        # psycopg2 is a C extension that gevent cannot monkey patch; make it
+        # yield to the event loop while waiting on the socket instead
+        from psycogreen.gevent import patch_psycopg
+
+        patch_psycopg()
+
+
+def on_starting(server):
+    # files left by a previous run would be added to this one's metrics
+    path = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
@@ -1,14 +1,26 @@
+import json
 import sys
 
+import click
+from flask import current_app
 from flask.cli import FlaskGroup
 
 from src import create_app, db
 from src.api.users.models import User
-from src.api.places.models import Place
+from src.api.places.sync import sync_places as sync_place_rows
+from src.api.places.crud import backfill_ratings as backfill_place_ratings
+from src.api.reviews.crud import backfill_review_search as backfill_search_vectors
+from src.api.places.tiles import MAX_ZOOM, get_tile, tiles_covering
+from src.api.reviews.importer import BATCH_SIZE
+from src.api.reviews.importer import import_reviews as import_review_rows
+from src.migrations import run_migrations
+from src.replicas import replica_status
+from src.slow_queries import read_log, slow_query_report
+from src.synthetic import CAMPUS_BOUNDS
+from src.synthetic import generate_synthetic as generate_synthetic_rows
 
-from get_mapdata import get_mapdata
+from get_mapdata import get_mapdata, save_snapshot
 
-app = create_app()
 cli = FlaskGroup(create_app=create_app)
 
 
@@ -19,26 +31,161 @@ def recreate_db():
     db.session.commit()
 
 
+@cli.command("migrate_db")
+def migrate_db():
+    run_migrations()
+
+
+@cli.command("replica_status")
+def show_replica_status():
+    """Prints each read replica's lag behind the primary."""
+    status = replica_status(current_app, db)
+    if not status:
+        print("No replicas configured (DATABASE_REPLICA_URLS).")
+    for bind, lag in status.items():
+        print(
+            f"{bind}: " + ("unreachable or unknown" if lag is None else f"{lag:.3f}s")
+        )
+
+
+@cli.command("slow_queries")
+@click.option("--limit", default=20, show_default=True)
+@click.option("--plans", is_flag=True, help="Print each statement's captured plan.")
+def slow_queries(limit, plans):
+    """Summarizes the slow-query log by statement, worst total time first."""
+    config = current_app.config
+    entries = read_log(config["SLOW_QUERY_LOG"], config["SLOW_QUERY_LOG_BACKUPS"])
+    report = slow_query_report(entries, limit)
+    if not report:
+        print(f"No slow queries logged in {config['SLOW_QUERY_LOG']}.")
+    for rank, group in enumerate(report, start=1):
+        print(
+            "{rank}. {total_ms:.0f} ms total, {count} runs, "
+            "{mean_ms:.1f} ms mean, {max_ms:.1f} ms max".format(rank=rank, **group)
+        )
+        print(f"   {group['fingerprint']}")
+        for caller, count in group["callers"]:
+            if caller:
+                print(f"   caller: {caller} ({count})")
+        for route, count in group["routes"]:
+            print(f"   route: {route} ({count})")
+        if plans and group["plan"] is not None:
+            print(json.dumps(group["plan"], indent=2))
+
+
+@cli.command("backfill_ratings")
+def backfill_ratings():
+    updated = backfill_place_ratings()
+    print(f"Recomputed ratings for {updated} places.")
+
+
+@cli.command("backfill_review_search")
+@click.option("--batch-size", default=10000, show_default=True)
+def backfill_review_search(batch_size):
+    """Fills the full-text search column of older reviews, in batches."""
+    updated = backfill_search_vectors(batch_size, echo=print)
+    print(f"Indexed {updated} reviews for search.")
+
+
+@cli.command("dump_mapdata")
+@click.argument("path")
+def dump_mapdata(path):
+    """Saves the current map data to a snapshot file for seed_db --snapshot."""
+    mdata = get_mapdata()
+    save_snapshot(path, mdata)
+    print(f"Saved {len(mdata)} places to {path}.")
+
+
 @cli.command("seed_db")
-def seed_db():
+@click.option("--snapshot", help="Seed from a dump_mapdata file, offline.")
+def seed_db(snapshot):
     db.session.add(User(email="test123@cornell.edu", password="1234", username="test1"))
     db.session.add(
         User(email="testuser1234@cornell.edu", password="1234", username="test2")
     )
     db.session.commit()
 
-    mdata = get_mapdata()
-    for data in mdata:
-        db.session.add(
-            Place(
-                lat=data["lat"],
-                lon=data["lon"],
-                name=data["name"],
-                types=data["types"],
-                image_url=data["image_url"],
-            )
-        )
-    db.session.commit()
+    sync_place_rows(get_mapdata(snapshot=snapshot))
+
+
+@cli.command("sync_places")
+@click.option("--snapshot", help="Sync from a dump_mapdata file, offline.")
+@click.option("--dry-run", is_flag=True, help="Report changes without applying them.")
+def sync_places(snapshot, dry_run):
+    """Brings places up to date with the map data, keeping user data."""
+    report = sync_place_rows(get_mapdata(snapshot=snapshot), dry_run=dry_run)
+    print(
+        "{inserted} inserted, {updated} updated, {deleted} deleted, "
+        "{kept} kept (have reviews or favorites)".format(**report)
+    )
+
+
+@cli.command("import_reviews")
+@click.argument("path", type=click.File("r", encoding="utf-8"))
+@click.option(
+    "--format",
+    "fmt",
+    type=click.Choice(["csv", "ndjson"]),
+    help="Defaults to ndjson for .ndjson/.jsonl files, csv otherwise.",
+)
+@click.option("--batch-size", default=BATCH_SIZE, show_default=True)
+@click.option("--dry-run", is_flag=True, help="Validate and merge, then roll back.")
+def import_reviews(path, fmt, batch_size, dry_run):
+    """Bulk imports reviews from a CSV or NDJSON file ("-" for stdin)."""
+    if fmt is None:
+        fmt = "ndjson" if path.name.endswith((".ndjson", ".jsonl")) else "csv"
+    report = import_review_rows(path, fmt, dry_run=dry_run, batch_size=batch_size)
+    for error in report["errors"]:
+        print(error)
+    print(
+        "{read} read, {inserted} inserted, {invalid} invalid, "
+        "{unknown_user} unknown user, {unknown_place} unknown place, "
+        "{duplicates} duplicates; {places} places rerated".format(**report)
+    )
+    print(
+        "{seconds:.1f}s, {rows_per_second:.0f} rows/sec".format(**report)
+        + (" (dry run, rolled back)" if dry_run else "")
+    )
+
+
+@cli.command("warm_tiles")
+@click.option("--min-zoom", default=12, show_default=True)
+@click.option("--max-zoom", default=MAX_ZOOM, show_default=True)
+@click.option(
+    "--bounds",
+    default=",".join(str(b) for b in CAMPUS_BOUNDS),
+    show_default=True,
+    help="south,west,north,east",
+)
+def warm_tiles(min_zoom, max_zoom, bounds):
+    """Renders and stores the map tiles covering the campus."""
+    south, west, north, east = (float(b) for b in bounds.split(","))
+    count = 0
+    for z in range(min_zoom, min(max_zoom, MAX_ZOOM) + 1):
+        for x, y in tiles_covering(south, west, north, east, z):
+            get_tile(z, x, y)
+            count += 1
+    print(f"{count} tiles ready.")
+
+
+@cli.command("generate_synthetic")
+@click.option("--places", default=100000, show_default=True)
+@click.option("--users", default=10000, show_default=True)
+@click.option("--reviews", default=1000000, show_default=True)
+@click.option("--favorites", default=100000, show_default=True)
+@click.option("--clusters", default=60, show_default=True)
+@click.option("--seed", default=0, show_default=True)
+def generate_synthetic(places, users, reviews, favorites, clusters, seed):
+    """Bulk loads clustered synthetic places, users, reviews and favorites."""
+    written = generate_synthetic_rows(
+        places=places,
+        users=users,
+        reviews=reviews,
+        favorites=favorites,
+        clusters=clusters,
+        seed=seed,
+    )
+    print(", ".join(f"{count} {kind}" for kind, count in written.items()))
 
 
 if __name__ == "__main__":
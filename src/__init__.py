@@ -1,15 +1,14 @@
 import os
 
 from flask import Flask
-from flask_admin import Admin
 from flask_cors import CORS
-from flask_sqlalchemy import SQLAlchemy
 from werkzeug.middleware.proxy_fix import ProxyFix
 
+from src import metrics, query_stats, replicas, slow_queries
+
 # instantiate the extensions
-db = SQLAlchemy()
+db = replicas.RoutingSQLAlchemy()
 cors = CORS()
-admin = Admin(template_mode="bootstrap3")
 
 
 def create_app(script_info=None):
@@ -23,16 +22,31 @@ def create_app(script_info=None):
     app.config.from_object(app_settings)
 
     # set up extensions
+    replicas.init_app(app)
+    metrics.init_app(app)
     db.init_app(app)
+    query_stats.init_app(app)
+    slow_queries.init_app(app)
     cors.init_app(app, resources={r"*": {"origins": "*"}})
-    if os.getenv("FLASK_ENV") == "development":
-        admin.init_app(app)
-
     # register api
     from src.api import api
 
     api.init_app(app)
 
+    if os.getenv("FLASK_ENV") == "development":
+        from src import admin
+
+        admin.init_app(app, db)
+
+    from src.api.users.crud import session_cache
+
+    session_cache.maxsize = app.config["SESSION_CACHE_SIZE"]
+    session_cache.ttl = app.config["SESSION_CACHE_TTL"]
+
+    from src.api.places.search_cache import search_cache
+
+    search_cache.configure(app.config)
+
     # shell context for flask cli
     @app.shell_context_processor
     def ctx():
@@ -0,0 +1,20 @@
+"""Flask-Admin views of the models, only set up in development.
+
+Imported by create_app when FLASK_ENV is development, so that production
+workers never load flask_admin and its form libraries."""
+from flask_admin import Admin
+
+from src.api.places.admin import PlacesAdminView
+from src.api.places.models import Place
+from src.api.reviews.admin import ReviewsAdminView
+from src.api.reviews.models import Review
+from src.api.users.admin import UsersAdminView
+from src.api.users.models import User
+
+
+def init_app(app, db):
+    admin = Admin(app, template_mode="bootstrap3")
+    admin.add_view(PlacesAdminView(Place, db.session))
+    admin.add_view(UsersAdminView(User, db.session))
+    admin.add_view(ReviewsAdminView(Review, db.session))
+    return admin
@@ -0,0 +1,72 @@
+import threading
+import time
+from collections import OrderedDict
+
+from src.metrics import cache_lookup
+
+
+class TTLCache:
+    """Thread-safe, size-bounded LRU cache whose entries also expire.
+
+    Every process has its own copy, so anything cached here must tolerate
+    being stale for up to `ttl` seconds in the other gunicorn workers.
+    Lookups in a cache with a `name` are counted in the metrics.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60, name=None):
+        self.maxsize = maxsize
+        self.name = name
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is not None and expires_at <= time.monotonic():
+                    del self._data[key]
+                    entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self._data.move_to_end(key)
+                self.hits += 1
+        if self.name is not None:
+            cache_lookup(self.name, "miss" if entry is None else "hit")
+        return default if entry is None else value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        if self.maxsize <= 0 or (ttl is not None and ttl <= 0):
+            return
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def keys(self):
+        with self._lock:
+            return list(self._data.keys())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,76 @@
+from flask import Response, request, stream_with_context
+from flask_restx import reqparse
+from werkzeug.urls import url_encode
+
+from src.api.serializers import dumps
+
+STREAM_BATCH_SIZE = 500
+
+
+def add_pagination_arguments(parser=None):
+    """limit/cursor for keyset pagination on id, stream for json/ndjson output."""
+    if parser is None:
+        parser = reqparse.RequestParser()
+    parser.add_argument("limit", type=int, required=False)
+    parser.add_argument("cursor", type=int, required=False)
+    parser.add_argument("stream", choices=("json", "ndjson"), required=False)
+    return parser
+
+
+def keyset_page(query, column, cursor=None, limit=None):
+    """Returns (items, next_cursor) for the rows of query after `cursor`,
+    ordered by `column`. next_cursor is None on the last page."""
+    query = query.order_by(column)
+    if cursor is not None:
+        query = query.filter(column > cursor)
+    if not limit or limit <= 0:
+        return query.all(), None
+
+    items = query.limit(limit + 1).all()
+    if len(items) <= limit:
+        return items, None
+    items = items[:limit]
+    return items, getattr(items[-1], column.key)
+
+
+def keyset_stream(query, column, cursor=None, limit=None):
+    """Like keyset_page, but iterates over a server-side cursor in batches of
+    STREAM_BATCH_SIZE instead of loading every row."""
+    query = query.order_by(column)
+    if cursor is not None:
+        query = query.filter(column > cursor)
+    if limit and limit > 0:
+        query = query.limit(limit)
+    return query.execution_options(stream_results=True).yield_per(STREAM_BATCH_SIZE)
+
+
+def next_page_headers(next_cursor):
+    if next_cursor is None:
+        return {}
+    args = request.args.to_dict()
+    args["cursor"] = next_cursor
+    url = f"{request.base_url}?{url_encode(args)}"
+    return {"Link": f'<{url}>; rel="next"', "X-Next-Cursor": str(next_cursor)}
+
+
+def stream_response(items, serialize, fmt="json"):
+    """Streams `items` as one JSON array, or as one JSON document per line for
+    fmt="ndjson", serializing each item with `serialize` as it is fetched."""
+
+    def generate_ndjson():
+        for item in items:
+            yield dumps(serialize(item)) + b"\n"
+
+    def generate_json():
+        yield b"["
+        separator = b""
+        for item in items:
+            yield separator + dumps(serialize(item))
+            separator = b","
+        yield b"]\n"
+
+    if fmt == "ndjson":
+        generate, mimetype = generate_ndjson, "application/x-ndjson"
+    else:
+        generate, mimetype = generate_json, "application/json"
+    return Response(stream_with_context(generate()), mimetype=mimetype)
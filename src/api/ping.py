@@ -1,5 +1,9 @@
+from flask import current_app
 from flask_restx import Namespace, Resource
 
+from src import db
+from src.replicas import replica_status
+
 ping_namespace = Namespace("ping")
 
 
@@ -8,4 +12,11 @@ class Ping(Resource):
         return {"status": "success", "message": "pong"}
 
 
+class PingReplicas(Resource):
+    def get(self):
+        """Returns the lag in seconds of each read replica, null if unknown."""
+        return {"replicas": replica_status(current_app, db)}
+
+
 ping_namespace.add_resource(Ping, "")
+ping_namespace.add_resource(PingReplicas, "/replicas")
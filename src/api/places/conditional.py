@@ -0,0 +1,98 @@
+import datetime
+import hashlib
+from functools import wraps
+
+from flask import Response, request
+from flask_restx.utils import unpack
+from werkzeug.http import http_date
+
+from src.api.places.crud import (
+    get_catalog_version,
+    get_place_version,
+    get_ratings_version,
+)
+from src.metrics import cache_lookup
+
+
+def _utc_seconds(value):
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value.replace(microsecond=0)
+
+
+def _not_modified(etag, updated_at):
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since and updated_at is not None:
+        return _utc_seconds(updated_at) <= _utc_seconds(request.if_modified_since)
+    return False
+
+
+def _conditional(func, get_version):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        version, updated_at = get_version(**kwargs)
+        digest = hashlib.sha1(request.full_path.encode("utf-8")).hexdigest()[:16]
+        etag = f"{version}-{digest}"
+
+        headers = {"ETag": f'"{etag}"', "Cache-Control": "no-cache"}
+        if updated_at is not None:
+            headers["Last-Modified"] = http_date(_utc_seconds(updated_at))
+
+        if _not_modified(etag, updated_at):
+            cache_lookup("etag", "hit")
+            return Response(status=304, headers=headers)
+        cache_lookup("etag", "miss")
+
+        resp = func(*args, **kwargs)
+        if isinstance(resp, Response):
+            if resp.status_code == 200:
+                resp.headers.extend(headers)
+            return resp
+
+        data, code, resp_headers = unpack(resp)
+        if code == 200:
+            resp_headers = dict(resp_headers or {}, **headers)
+        return data, code, resp_headers
+
+    return wrapper
+
+
+def _catalog_version(**kwargs):
+    return get_catalog_version()
+
+
+def _rating_version(version, rating_updated_at, updated_at):
+    if rating_updated_at is not None:
+        version = f"{version}.{int(rating_updated_at.timestamp() * 1000000)}"
+    return version, updated_at
+
+
+def _place_version(place_id, **kwargs):
+    return _rating_version(*get_place_version(place_id))
+
+
+def _ratings_version(**kwargs):
+    return _rating_version(*get_ratings_version())
+
+
+def catalog_conditional(func):
+    """Conditional GET for responses that only change with the place catalog.
+
+    The strong ETag combines the catalog version with the request path and
+    query string. A matching If-None-Match (or a fresh If-Modified-Since)
+    gets a 304 before the handler, and so its queries and marshalling, runs.
+    Must be applied above marshal_with."""
+    return _conditional(func, _catalog_version)
+
+
+def ratings_conditional(func):
+    """catalog_conditional for responses that also carry the ratings of
+    their places, and so also change with the latest rating change."""
+    return _conditional(func, _ratings_version)
+
+
+def place_conditional(func):
+    """catalog_conditional for the responses of one place, given by the
+    place_id argument, which also change with the place's rating."""
+    return _conditional(func, _place_version)
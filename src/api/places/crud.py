@@ -1,24 +1,274 @@
 # import json
 
+from flask import current_app
+
 from src import db
-from src.api.reviews.models import Review
-from src.api.places.models import Place
-from sqlalchemy import func
+from src.api.pagination import keyset_page, keyset_stream
+from src.api.places.engine import place_index
+from src.api.places.models import CatalogVersion, Place, point_wkt
+from src.api.places.search_cache import search_cache
+from src.api.places.tiles import invalidate_tiles, padded_envelope
+from src.replicas import primary_reads, reads_primary, replica_reads
+from sqlalchemy import Float, case, cast, func, text, true
+from sqlalchemy.dialects.postgresql import insert
+from geoalchemy2 import Geography
 
 # from geoalchemy2.shape import to_shape
 
 
+def geography_point(lat, lon):
+    """Search origin as a geography, so that ST_DWithin and <-> can use the
+    GiST index on places.coords."""
+    return func.ST_SetSRID(func.ST_MakePoint(lon, lat), 4326).cast(
+        Geography(geometry_type="POINT", srid=4326)
+    )
+
+
+def use_place_index():
+    return current_app.config.get("PLACES_SEARCH_ENGINE") == "memory"
+
+
+def place_index_row(place):
+    return {
+        "id": place.id,
+        "name": place.name,
+        "types": place.types,
+        "lat": place.lat,
+        "lon": place.lon,
+        "image_url": place.image_url,
+        "rating": place.rating,
+    }
+
+
+def _place_row_query():
+    return db.session.query(
+        Place.id,
+        Place.name,
+        Place.types,
+        Place.lat,
+        Place.lon,
+        Place.image_url,
+        Place.rating.label("rating"),
+    )
+
+
+@primary_reads
+def load_place_index():
+    return [row._asdict() for row in _place_row_query()]
+
+
+@primary_reads
+def load_search_cell(lat, lon, types, radius, limit):
+    """Row dicts of the places of `types` within `radius` meters, for the
+    search cache; at most `limit`. Read from the primary: a lagging replica
+    could refill a cell invalidated by a write with the rows before it."""
+    rows = (
+        _place_row_query()
+        .filter(
+            Place.types == types,
+            func.ST_DWithin(Place.coords, geography_point(lat, lon), radius),
+        )
+        .limit(limit)
+    )
+    return [row._asdict() for row in rows]
+
+
+def refresh_place_index(place_id):
+    """Refreshes a place's copies in place_index and the search cache after
+    a committed write that changed its rating."""
+    if not place_index.loaded and not search_cache.enabled:
+        return
+    place = get_place_by_id(place_id)
+    if place is not None:
+        place_index.upsert(place_index_row(place))
+        search_cache.invalidate(place.types, place.lat, place.lon)
+
+
+@replica_reads
+def get_catalog_version():
+    """Returns (version, updated_at), (0, None) before the first write."""
+    row = (
+        db.session.query(CatalogVersion.version, CatalogVersion.updated_at)
+        .filter(CatalogVersion.id == 1)
+        .first()
+    )
+    if row is None:
+        return 0, None
+    return row.version, row.updated_at
+
+
+def _with_rating_version(rating_updated_at):
+    version, updated_at = get_catalog_version()
+    if rating_updated_at is not None and (
+        updated_at is None or rating_updated_at > updated_at
+    ):
+        updated_at = rating_updated_at
+    return version, rating_updated_at, updated_at
+
+
+@replica_reads
+def get_place_version(place_id):
+    """Returns (version, rating_updated_at, updated_at) of a place: the
+    catalog version, when the place's rating last changed and the later of
+    that and the catalog's updated_at. (0, None, None) before the first
+    write."""
+    rating_updated_at = (
+        db.session.query(Place.rating_updated_at).filter(Place.id == place_id).scalar()
+    )
+    return _with_rating_version(rating_updated_at)
+
+
+@replica_reads
+def get_ratings_version():
+    """get_place_version for responses with the ratings of many places:
+    rating_updated_at is the last rating change of any place."""
+    rating_updated_at = db.session.query(func.max(Place.rating_updated_at)).scalar()
+    return _with_rating_version(rating_updated_at)
+
+
+def bump_catalog_version():
+    """Marks the place catalog as changed. Call inside the writing
+    transaction, before its commit."""
+    statement = insert(CatalogVersion).values(id=1, version=1, updated_at=func.now())
+    db.session.execute(
+        statement.on_conflict_do_update(
+            index_elements=[CatalogVersion.id],
+            set_={
+                "version": CatalogVersion.version + 1,
+                "updated_at": func.now(),
+            },
+        )
+    )
+
+
+def _place_query(fields=None):
+    """Place entities, or with `fields` (names of Place attributes) plain row
+    tuples of those columns, which are much cheaper to load."""
+    if fields is None:
+        return Place.query
+    return db.session.query(*[getattr(Place, field) for field in fields])
+
+
+@replica_reads
 def get_all_places():
     return Place.query.all()
 
 
+@replica_reads
+def get_places_page(cursor=None, limit=None, fields=None):
+    return keyset_page(_place_query(fields), Place.id, cursor, limit)
+
+
+@replica_reads
+def stream_places(cursor=None, limit=None, fields=None):
+    return keyset_stream(_place_query(fields), Place.id, cursor, limit)
+
+
+@replica_reads
+def get_places_in_bbox(south, west, north, east, types=None, limit=500, fields=None):
+    """Places inside a lat/lon rectangle, by id, as (places, truncated).
+
+    Candidates come from the GiST index on places.coords through && with the
+    rectangle's envelope; truncated is True when more than `limit` places
+    matched. The query has no ORDER BY, which could steer the planner to the
+    primary key index, so a truncated result is an arbitrary subset."""
+    query = _place_query(fields).filter(
+        Place.lat.between(south, north), Place.lon.between(west, east)
+    )
+    envelope = padded_envelope(south, west, north, east)
+    if envelope is not None:
+        pad_south, pad_west, pad_north, pad_east = envelope
+        box = func.ST_MakeEnvelope(pad_west, pad_south, pad_east, pad_north, 4326)
+        query = query.filter(
+            Place.coords.op("&&")(
+                box.cast(Geography(geometry_type="POLYGON", srid=4326))
+            )
+        )
+    if types:
+        query = query.filter(Place.types == types)
+
+    places = query.limit(limit + 1).all()
+    truncated = len(places) > limit
+    return sorted(places[:limit], key=lambda place: place.id), truncated
+
+
 def get_place_by_id(place_id):
     return Place.query.filter_by(id=place_id).first()
 
 
+@replica_reads
 def get_rating_by_id(place_id):
+    return db.session.query(Place.rating).filter(Place.id == place_id).scalar()
+
+
+@replica_reads
+def get_ratings_by_ids(place_ids):
+    rows = db.session.query(Place.id, Place.rating).filter(Place.id.in_(place_ids))
+    return {place_id: rating for place_id, rating in rows}
+
+
+BACKFILL_RATINGS_SQL = """
+UPDATE places
+SET rating_sum = COALESCE(t.rating_sum, 0),
+    rating_count = COALESCE(t.rating_count, 0),
+    rating_updated_at = clock_timestamp()
+FROM places AS p
+LEFT JOIN (
+    SELECT place_id, SUM(rating) AS rating_sum, COUNT(*) AS rating_count
+    FROM reviews
+    GROUP BY place_id
+) AS t ON t.place_id = p.id
+WHERE places.id = p.id
+"""
+
+
+def backfill_ratings():
+    """Recomputes rating_sum/rating_count for every place from reviews."""
+    updated = db.session.execute(text(BACKFILL_RATINGS_SQL)).rowcount
+    db.session.commit()
+    place_index.clear()
+    search_cache.clear()
+    return updated
+
+
+# Reviews a place needs before its own average outweighs its type's mean
+BAYESIAN_PRIOR_WEIGHT = 5
+
+
+@replica_reads
+def get_top_places(types, k=10, min_reviews=0):
+    """Places of `types` ranked by Bayesian average rating, as (Place, score).
+
+    The score shrinks each place's average towards the mean of its type:
+    (mean * w + rating_sum) / (w + rating_count). It is computed from the
+    rating aggregates stored on places, so ranking never touches reviews."""
+    totals = (
+        db.session.query(
+            func.sum(Place.rating_sum).label("rating_sum"),
+            func.sum(Place.rating_count).label("rating_count"),
+        )
+        .filter(Place.types == types)
+        .subquery()
+    )
+    mean = case(
+        [
+            (
+                totals.c.rating_count > 0,
+                cast(totals.c.rating_sum, Float) / totals.c.rating_count,
+            )
+        ],
+        else_=0,
+    )
+    score = (mean * BAYESIAN_PRIOR_WEIGHT + Place.rating_sum) / (
+        BAYESIAN_PRIOR_WEIGHT + Place.rating_count
+    )
     return (
-        db.session.query(func.avg(Review.rating)).filter_by(place_id=place_id).scalar()
+        db.session.query(Place, score.label("score"))
+        .join(totals, true())
+        .filter(Place.types == types, Place.rating_count >= max(min_reviews, 0))
+        .order_by(score.desc(), Place.id)
+        .limit(k)
+        .all()
     )
 
 
@@ -30,65 +280,130 @@ def get_place_by_name(place_name):
 def add_place(lat, lon, name, types, image_url):
     place = Place(lat, lon, name, types, image_url)
     db.session.add(place)
+    bump_catalog_version()
+    invalidate_tiles(lat, lon)
     db.session.commit()
+    place_index.upsert(place_index_row(place))
+    search_cache.invalidate(types, lat, lon)
     return place
 
 
 def update_place(place, lat, lon, name, types, image_url):
-    place.coords = f"POINT({lon} {lat})"
+    old_position = (place.types, place.lat, place.lon)
+    place.coords = point_wkt(lat, lon)
+    place.lat = lat
+    place.lon = lon
     place.name = name
     place.types = types
     place.image_url = image_url
+    bump_catalog_version()
+    invalidate_tiles(*old_position[1:])
+    invalidate_tiles(lat, lon)
     db.session.commit()
+    place_index.upsert(place_index_row(place))
+    search_cache.invalidate(*old_position)
+    search_cache.invalidate(types, lat, lon)
     return place
 
 
 def delete_place(place):
+    place_id = place.id
+    old_position = (place.types, place.lat, place.lon)
     db.session.delete(place)
+    bump_catalog_version()
+    invalidate_tiles(*old_position[1:])
     db.session.commit()
+    place_index.remove(place_id)
+    search_cache.invalidate(*old_position)
     return place
 
 
-def get_knearest_places(lat, lon, types, m=-1, k=5):
+@replica_reads
+def get_knearest_places(lat, lon, types, m=-1, k=5, fields=None):
+    if use_place_index():
+        place_index.ensure_loaded(
+            load_place_index, current_app.config.get("PLACES_ENGINE_MAX_AGE")
+        )
+        return place_index.search(lat, lon, types, m, k)
+
     if k < 0:
         k = 0
+    # read-your-writes requests skip the cache as they skip replicas
+    if m > 0 and not reads_primary():
+        cached = search_cache.search(lat, lon, types, m, k, load_search_cell)
+        if cached is not None:
+            return cached
+
+    query = _place_query(fields).filter(Place.types == types)
     if m <= 0:
-        pllist = Place.query.filter_by(types=types).all()
-        return pllist
+        return query.all()
 
-    temp = Place(lat=lat, lon=lon, name="temp_place", types="temp_type")
-    db.session.add(temp)
-    db.session.commit()
-    m = int(m)
-
-    try:
-        placesnearby = (
-            Place.query.filter(
-                func.ST_DistanceSphere(
-                    func.ST_Point(Place.lat, Place.lon), func.ST_Point(lat, lon)
-                )
-                < m
-            )
-            .order_by(
-                func.ST_DistanceSphere(
-                    func.ST_Point(Place.lat, Place.lon), func.ST_Point(lat, lon)
-                )
-            )
-            .limit(k)
-        )
+    origin = geography_point(lat, lon)
+    return (
+        query.filter(func.ST_DWithin(Place.coords, origin, int(m)))
+        .order_by(Place.coords.op("<->")(origin))
+        .limit(k)
+        .all()
+    )
+
+
+BATCH_SEARCH_SQL = """
+SELECT q.idx, p.id, p.name, p.types, p.lat, p.lon, p.image_url,
+       CASE WHEN p.rating_count > 0 THEN p.rating_sum / p.rating_count ELSE 0 END AS rating
+FROM (VALUES {values}) AS q (idx, lat, lon, types, m, k)
+CROSS JOIN LATERAL (
+    SELECT places.*,
+           places.coords <-> ST_SetSRID(ST_MakePoint(q.lon, q.lat), 4326)::geography AS distance
+    FROM places
+    WHERE places.types = q.types
+      AND (q.m <= 0 OR ST_DWithin(places.coords, ST_SetSRID(ST_MakePoint(q.lon, q.lat), 4326)::geography, q.m))
+    ORDER BY distance
+    LIMIT CASE WHEN q.m <= 0 THEN NULL ELSE GREATEST(q.k, 0) END
+) AS p
+ORDER BY q.idx, p.distance
+"""
 
-        res = []
-        for temppl in placesnearby:
-            if (temppl != temp) and (temppl.types == types):
-                res.append(temppl)
+BATCH_VALUES_ROW = (
+    "(CAST(:idx{i} AS integer), CAST(:lat{i} AS double precision), "
+    "CAST(:lon{i} AS double precision), CAST(:types{i} AS varchar), "
+    "CAST(:m{i} AS integer), CAST(:k{i} AS integer))"
+)
 
-    except Exception as e:
-        print("exception: ", e)
 
-        db.session.delete(temp)
-        db.session.commit()
-    else:
-        db.session.delete(temp)
-        db.session.commit()
+@replica_reads
+def get_knearest_places_batch(queries):
+    """Answers many get_knearest_places queries in one round trip.
+
+    Each query is a dict with lat, lon, types, m and k; the result maps the
+    query's position in the list to its places, as dicts of Place columns."""
+    results = {idx: [] for idx in range(len(queries))}
+    if not queries:
+        return results
+
+    if use_place_index():
+        for idx, query in enumerate(queries):
+            results[idx] = get_knearest_places(
+                query.get("lat") or 0,
+                query.get("lon") or 0,
+                query["types"],
+                query.get("m") or -1,
+                query.get("k") or 0,
+            )
+        return results
+
+    values = []
+    params = {}
+    for idx, query in enumerate(queries):
+        values.append(BATCH_VALUES_ROW.format(i=idx))
+        params[f"idx{idx}"] = idx
+        params[f"lat{idx}"] = query.get("lat") or 0
+        params[f"lon{idx}"] = query.get("lon") or 0
+        params[f"types{idx}"] = query["types"]
+        params[f"m{idx}"] = query.get("m") or -1
+        params[f"k{idx}"] = query.get("k") or 0
 
-    return res
+    statement = text(BATCH_SEARCH_SQL.format(values=", ".join(values)))
+    for row in db.session.execute(statement, params):
+        place = dict(row)
+        results[place.pop("idx")].append(place)
+    return results
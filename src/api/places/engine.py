@@ -0,0 +1,131 @@
+import threading
+import time
+
+import numpy as np
+
+EARTH_RADIUS_M = 6371008.8
+
+
+def haversine(lat, lon, lats, lons):
+    """Great-circle distance in meters from (lat, lon), in degrees, to every
+    point of the `lats`/`lons` arrays, in radians."""
+    lat, lon = np.radians(lat), np.radians(lon)
+    a = (
+        np.sin((lats - lat) / 2) ** 2
+        + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class _Partition:
+    """Coordinates of all places of one type, as parallel NumPy arrays."""
+
+    def __init__(self, records):
+        records = sorted(records, key=lambda r: r["id"])
+        self.records = records
+        self.lats = np.radians(np.array([r["lat"] for r in records], dtype=float))
+        self.lons = np.radians(np.array([r["lon"] for r in records], dtype=float))
+
+    def nearest(self, lat, lon, m, k):
+        """Up to k records within m meters of (lat, lon), nearest first."""
+        if k <= 0 or not self.records:
+            return []
+        distances = haversine(lat, lon, self.lats, self.lons)
+        (candidates,) = np.nonzero(distances <= m)
+        if len(candidates) > k:
+            nearest = np.argpartition(distances[candidates], k - 1)[:k]
+            candidates = candidates[nearest]
+        candidates = candidates[np.argsort(distances[candidates], kind="stable")]
+        return [self.records[i] for i in candidates]
+
+
+def nearest_records(records, lat, lon, m, k):
+    """Exact k-nearest search over a small list of place row dicts."""
+    return _Partition(records).nearest(lat, lon, m, k)
+
+
+class PlaceIndex:
+    """In-memory replacement for the PostGIS nearby-place search.
+
+    Place rows are kept per `types`, and radius/k-nearest queries are answered
+    with a vectorized haversine plus `argpartition`. Distances are spherical,
+    so places within a few centimeters of the radius may differ from
+    ST_DWithin, which measures on the spheroid.
+
+    The index is loaded lazily with `loader`, updated by `upsert`/`remove`
+    after place writes commit, and fully reloaded once older than `max_age`
+    seconds to pick up writes made by other worker processes.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._records = {}
+        self._partitions = {}
+        self._dirty = set()
+        self.loaded_at = None
+
+    @property
+    def loaded(self):
+        return self.loaded_at is not None
+
+    def load(self, rows):
+        with self._lock:
+            self._records = {row["id"]: dict(row) for row in rows}
+            self._partitions = {}
+            self._dirty = {row["types"] for row in self._records.values()}
+            self.loaded_at = time.monotonic()
+
+    def ensure_loaded(self, loader, max_age=None):
+        with self._lock:
+            expired = (
+                self.loaded
+                and max_age is not None
+                and time.monotonic() - self.loaded_at > max_age
+            )
+            if not self.loaded or expired:
+                self.load(loader())
+
+    def clear(self):
+        with self._lock:
+            self._records = {}
+            self._partitions = {}
+            self._dirty = set()
+            self.loaded_at = None
+
+    def upsert(self, row):
+        with self._lock:
+            if not self.loaded:
+                return
+            old = self._records.get(row["id"])
+            if old is not None:
+                self._dirty.add(old["types"])
+            self._records[row["id"]] = dict(row)
+            self._dirty.add(row["types"])
+
+    def remove(self, place_id):
+        with self._lock:
+            old = self._records.pop(place_id, None)
+            if old is not None:
+                self._dirty.add(old["types"])
+
+    def _partition(self, types):
+        with self._lock:
+            if types in self._dirty:
+                records = [r for r in self._records.values() if r["types"] == types]
+                self._partitions[types] = _Partition(records)
+                self._dirty.discard(types)
+            return self._partitions.get(types)
+
+    def search(self, lat, lon, types, m=-1, k=5):
+        """Same contract as crud.get_knearest_places, returning row dicts."""
+        if k < 0:
+            k = 0
+        partition = self._partition(types)
+        if partition is None:
+            return []
+        if m <= 0:
+            return list(partition.records)
+        return partition.nearest(lat, lon, m, k)
+
+
+place_index = PlaceIndex()
@@ -1,10 +1,16 @@
-import os
 from geoalchemy2 import Geography
+from sqlalchemy import case, func
+from sqlalchemy.ext.hybrid import hybrid_property
 from src import db
 
 DEFAULT_IMG = "https://cornell-places-assets.s3.amazonaws.com/cornell_img.jpg"
 
 
+def point_wkt(lat, lon):
+    # WKT points are (x y), i.e. (lon lat)
+    return f"POINT({lon} {lat})"
+
+
 class Place(db.Model):
 
     __tablename__ = "places"
@@ -13,17 +19,41 @@ class Place(db.Model):
     name = db.Column(db.String, nullable=False)
     lat = db.Column(db.Float, nullable=False)
     lon = db.Column(db.Float, nullable=False)
-    coords = db.Column(Geography(geometry_type="POINT", srid=4326), nullable=False)
-    types = db.Column(db.VARCHAR(255), nullable=False)
+    coords = db.Column(
+        Geography(geometry_type="POINT", srid=4326, spatial_index=True), nullable=False
+    )
+    types = db.Column(db.VARCHAR(255), nullable=False, index=True)
     image_url = db.Column(db.String, default=DEFAULT_IMG)
+    # Kept in step with reviews by src/api/reviews/crud.py
+    rating_sum = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    rating_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    # Set whenever rating_sum/rating_count change, for the ETags of the
+    # responses with ratings, as reviews don't bump the catalog version.
+    # Indexed for max(), see get_ratings_version.
+    rating_updated_at = db.Column(db.DateTime(timezone=True), index=True)
 
     def __init__(self, lat, lon, name, types, image_url=DEFAULT_IMG):
-        self.coords = f"POINT({lat} {lon})"
+        self.coords = point_wkt(lat, lon)
         self.name = name
         self.types = types
         self.lat = lat
         self.lon = lon
         self.image_url = image_url
+        self.rating_sum = 0
+        self.rating_count = 0
+
+    @hybrid_property
+    def rating(self):
+        """Average review rating, truncated to an int. 0 if there are no reviews."""
+        if not self.rating_count:
+            return 0
+        return self.rating_sum // self.rating_count
+
+    @rating.expression
+    def rating(cls):
+        return case(
+            [(cls.rating_count > 0, cls.rating_sum / cls.rating_count)], else_=0
+        )
 
     def serialize(self):
         return {
@@ -35,8 +65,30 @@ class Place(db.Model):
         }
 
 
-if os.getenv("FLASK_ENV") == "development":
-    from src import admin
-    from src.api.places.admin import PlacesAdminView
+class CatalogVersion(db.Model):
+    """Single row bumped by every write to the place catalog, used for the
+    ETag and Last-Modified headers of the places endpoints. Review writes
+    don't bump it, see Place.rating_updated_at."""
+
+    __tablename__ = "catalog_version"
+
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=1)
+    updated_at = db.Column(
+        db.DateTime(timezone=True), nullable=False, default=func.now()
+    )
+
+
+class PlaceTile(db.Model):
+    """Encoded JSON of a rendered map tile, see src/api/places/tiles.py.
+    Rows are deleted by the writes that change the tile."""
+
+    __tablename__ = "place_tiles"
 
-    admin.add_view(PlacesAdminView(Place, db.session))
+    z = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    x = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    y = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    payload = db.Column(db.Text, nullable=False)
+    created_at = db.Column(
+        db.DateTime(timezone=True), nullable=False, default=func.now()
+    )
@@ -0,0 +1,336 @@
+"""Result cache for nearby-place searches, shared by nearby origins.
+
+Searches are keyed on (types, geohash cell of the origin, radius bucket)
+rather than on the exact origin. A miss loads every place of `types` that
+any origin in the cell could reach within the bucket's radius. That is the
+cell's candidate set. Every hit then re-ranks the candidates by exact
+distance from the real origin, so one entry serves every k and every
+radius up to the bucket's.
+
+Place writes call `invalidate`, which drops the cells whose candidate
+circle contains the place. Those cells are worked out from the place's
+position for every radius bucket, and their keys deleted directly, without
+listing the cache's keys.
+"""
+import json
+import logging
+import math
+import threading
+import time
+
+import numpy as np
+
+from src.api.cache import TTLCache
+from src.api.places.engine import EARTH_RADIUS_M, haversine, nearest_records
+from src.metrics import cache_lookup
+
+logger = logging.getLogger(__name__)
+
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+MIN_RADIUS_BUCKET_M = 50
+# past this many cells (near the poles) invalidate scans the keys instead
+MAX_INVALIDATED_CELLS = 20000
+
+
+def geohash(lat, lon, precision):
+    """The geohash cell of (lat, lon) with `precision` characters."""
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    cell = []
+    bits, value, even = 0, 0, True
+    while len(cell) < precision:
+        interval, coord = (lon_range, lon) if even else (lat_range, lat)
+        middle = (interval[0] + interval[1]) / 2
+        if coord >= middle:
+            value = (value << 1) | 1
+            interval[0] = middle
+        else:
+            value <<= 1
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            cell.append(GEOHASH_ALPHABET[value])
+            bits, value = 0, 0
+    return "".join(cell)
+
+
+def geohash_bounds(cell):
+    """(south, west, north, east) of a geohash cell."""
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    even = True
+    for char in cell:
+        value = GEOHASH_ALPHABET.index(char)
+        for shift in range(4, -1, -1):
+            interval = lon_range if even else lat_range
+            middle = (interval[0] + interval[1]) / 2
+            if (value >> shift) & 1:
+                interval[0] = middle
+            else:
+                interval[1] = middle
+            even = not even
+    return lat_range[0], lon_range[0], lat_range[1], lon_range[1]
+
+
+def radius_bucket(m):
+    """m rounded up to MIN_RADIUS_BUCKET_M times a power of two."""
+    bucket = MIN_RADIUS_BUCKET_M
+    while bucket < m:
+        bucket *= 2
+    return bucket
+
+
+def _cell_circle(cell):
+    """Center of the cell and its distance to the cell's corners in meters."""
+    south, west, north, east = geohash_bounds(cell)
+    lat, lon = (south + north) / 2, (west + east) / 2
+    half_diagonal = float(haversine(lat, lon, *_radians(north, east)))
+    return lat, lon, half_diagonal
+
+
+def _radians(lat, lon):
+    return math.radians(lat), math.radians(lon)
+
+
+def cells_near(lat, lon, reach, precision, limit=None):
+    """Every geohash cell with `precision` characters whose center is within
+    `reach` meters of (lat, lon), and a few more around them. None if that
+    would be more than `limit` cells."""
+    south, west, north, east = geohash_bounds(geohash(lat, lon, precision))
+    lat_step, lon_step = north - south, east - west
+    lat_reach = math.degrees(reach / EARTH_RADIUS_M)
+    # a degree of longitude is shortest at the poleward edge of the window
+    edge = math.radians(min(abs(lat) + lat_reach, 89.9))
+    lon_reach = min(lat_reach / math.cos(edge), 180.0)
+
+    cells = set()
+    rows, columns = int(lat_reach / lat_step) + 1, int(lon_reach / lon_step) + 1
+    if limit is not None and (2 * rows + 1) * (2 * columns + 1) > limit:
+        return None
+    for row in range(-rows, rows + 1):
+        sample_lat = (south + north) / 2 + row * lat_step
+        if not -90 < sample_lat < 90:
+            continue
+        for column in range(-columns, columns + 1):
+            sample_lon = (west + east) / 2 + column * lon_step
+            sample_lon = (sample_lon + 180) % 360 - 180
+            cells.add(geohash(sample_lat, sample_lon, precision))
+    return cells
+
+
+class RedisBackend:
+    """TTLCache's interface over a Redis-compatible server, so every worker
+    process shares one cache. Memory is bounded by the server: run it with
+    maxmemory and maxmemory-policy allkeys-lru. Server errors are logged and
+    treated as misses."""
+
+    def __init__(self, url, prefix="places-search:"):
+        import redis
+
+        self._redis = redis.Redis.from_url(url)
+        self._errors = redis.RedisError
+        self.prefix = prefix
+
+    def get(self, key, default=None):
+        try:
+            raw = self._redis.get(self.prefix + key)
+        except self._errors as e:
+            logger.warning("Search cache get failed: %s", e)
+            return default
+        return default if raw is None else json.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        try:
+            self._redis.set(self.prefix + key, json.dumps(value), ex=ttl or None)
+        except self._errors as e:
+            logger.warning("Search cache set failed: %s", e)
+
+    def delete(self, key):
+        self.delete_many([key])
+
+    def delete_many(self, keys):
+        keys = [self.prefix + key for key in keys]
+        if not keys:
+            return
+        try:
+            self._redis.delete(*keys)
+        except self._errors as e:
+            logger.warning("Search cache delete failed: %s", e)
+
+    def keys(self):
+        start = len(self.prefix)
+        try:
+            return [
+                key.decode("utf-8")[start:]
+                for key in self._redis.scan_iter(match=self.prefix + "*", count=1000)
+            ]
+        except self._errors as e:
+            logger.warning("Search cache scan failed: %s", e)
+            return []
+
+    def clear(self):
+        for key in self.keys():
+            self.delete(key)
+
+    def __len__(self):
+        return len(self.keys())
+
+
+class SearchCache:
+    """Nearby-search result cache, see the module docstring.
+
+    The backend is an in-process TTLCache (LRU, bounded to `maxsize`
+    cells) unless `configure` is given a redis:// url. With the in-process
+    backend, writes made in other worker processes are only seen once
+    entries expire after `ttl` seconds."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.backend = TTLCache()
+        self.enabled = True
+        self.ttl = 30
+        self.precision = 7
+        self.max_radius = 1600
+        self.max_candidates = 1000
+        self.reset_stats()
+
+    def configure(self, config):
+        url = config.get("SEARCH_CACHE_URL")
+        size = config.get("SEARCH_CACHE_SIZE", 4096)
+        self.ttl = config.get("SEARCH_CACHE_TTL", self.ttl)
+        self.precision = config.get("SEARCH_CACHE_PRECISION", self.precision)
+        self.max_radius = config.get("SEARCH_CACHE_MAX_RADIUS", self.max_radius)
+        self.max_candidates = config.get(
+            "SEARCH_CACHE_MAX_CANDIDATES", self.max_candidates
+        )
+        self.enabled = size > 0
+        if url:
+            self.backend = RedisBackend(url)
+        else:
+            self.backend = TTLCache(maxsize=size, ttl=self.ttl)
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.bypasses = 0
+            self.hit_seconds = 0.0
+            self.miss_seconds = 0.0
+
+    def _key(self, types, cell, bucket):
+        return f"{bucket}:{cell}:{types}"
+
+    def search(self, lat, lon, types, m, k, loader):
+        """k nearest places of `types` within m meters, as row dicts.
+
+        On a miss, loader(lat, lon, types, radius, limit) must return the
+        row dicts of every place of `types` within `radius` meters of
+        (lat, lon), or more than `limit - 1` rows if there are too many to
+        cache. Returns None when the search can't be served from the cache,
+        because it is too wide or its cell too dense."""
+        if not self.enabled or m <= 0 or m > self.max_radius:
+            self._count_bypass()
+            return None
+
+        started = time.perf_counter()
+        bucket = radius_bucket(m)
+        cell = geohash(lat, lon, self.precision)
+        key = self._key(types, cell, bucket)
+        entry = self.backend.get(key)
+        hit = entry is not None
+        if not hit:
+            center_lat, center_lon, half_diagonal = _cell_circle(cell)
+            rows = loader(
+                center_lat,
+                center_lon,
+                types,
+                bucket + half_diagonal,
+                self.max_candidates + 1,
+            )
+            if len(rows) > self.max_candidates:
+                rows = None
+            entry = {"rows": rows}
+            self.backend.set(key, entry, self.ttl)
+
+        if entry["rows"] is None:
+            self._count_bypass()
+            return None
+        result = nearest_records(entry["rows"], lat, lon, m, k)
+        cache_lookup("search", "hit" if hit else "miss")
+
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            if hit:
+                self.hits += 1
+                self.hit_seconds += elapsed
+            else:
+                self.misses += 1
+                self.miss_seconds += elapsed
+        return result
+
+    def _count_bypass(self):
+        cache_lookup("search", "bypass")
+        with self._lock:
+            self.bypasses += 1
+
+    def invalidate(self, types, lat, lon):
+        """Drops the cached cells of `types` whose candidates could include a
+        place at (lat, lon). Call after the place write commits, with the old
+        and the new position of moved places."""
+        if not self.enabled or lat is None or lon is None:
+            return
+        buckets = [MIN_RADIUS_BUCKET_M]
+        while buckets[-1] < radius_bucket(self.max_radius):
+            buckets.append(buckets[-1] * 2)
+
+        # a cell is affected when the place is within its bucket of the
+        # cell's circle, see search
+        half_diagonal = _cell_circle(geohash(lat, lon, self.precision))[2]
+        reach = buckets[-1] + half_diagonal
+        cells = cells_near(lat, lon, reach, self.precision, MAX_INVALIDATED_CELLS)
+        if cells is None:
+            self._invalidate_scan(types, lat, lon)
+            return
+        cells = list(cells)
+        circles = np.array([_cell_circle(cell) for cell in cells])
+        distances = haversine(lat, lon, *np.radians(circles[:, :2].T))
+        keys = [
+            self._key(types, cell, bucket)
+            for bucket in buckets
+            for cell, distance, half_diagonal in zip(cells, distances, circles[:, 2])
+            if distance <= bucket + half_diagonal
+        ]
+        self.backend.delete_many(keys)
+
+    def _invalidate_scan(self, types, lat, lon):
+        place_lat, place_lon = _radians(lat, lon)
+        for key in self.backend.keys():
+            bucket, cell, key_types = key.split(":", 2)
+            if key_types != types:
+                continue
+            center_lat, center_lon, half_diagonal = _cell_circle(cell)
+            distance = haversine(center_lat, center_lon, place_lat, place_lon)
+            if distance <= int(bucket) + half_diagonal:
+                self.backend.delete(key)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+            avg_hit = self.hit_seconds / hits if hits else 0.0
+            avg_miss = self.miss_seconds / misses if misses else 0.0
+            return {
+                "hits": hits,
+                "misses": misses,
+                "bypasses": self.bypasses,
+                "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+                "avg_hit_ms": avg_hit * 1000,
+                "avg_miss_ms": avg_miss * 1000,
+                # what the hits would have cost as misses
+                "saved_ms": hits * max(avg_miss - avg_hit, 0.0) * 1000,
+                "entries": len(self.backend),
+            }
+
+
+search_cache = SearchCache()
@@ -0,0 +1,187 @@
+import csv
+import io
+from collections import defaultdict
+
+import numpy as np
+from sqlalchemy import text
+
+from src import db
+from src.api.places.crud import bump_catalog_version
+from src.api.places.engine import haversine, place_index
+from src.api.places.search_cache import search_cache
+from src.api.places.tiles import clear_tiles
+
+# A row is the same place as an existing one with its name and types at
+# most this far away; nearest pairs are matched first
+MOVE_TOLERANCE_M = 100
+
+CREATE_STAGING_SQL = """
+CREATE TEMP TABLE places_staging (
+    place_id integer,
+    name varchar NOT NULL,
+    types varchar(255) NOT NULL,
+    lat double precision NOT NULL,
+    lon double precision NOT NULL,
+    image_url varchar
+) ON COMMIT DROP
+"""
+
+COPY_STAGING_SQL = (
+    "COPY places_staging (place_id, name, types, lat, lon, image_url) "
+    "FROM STDIN WITH (FORMAT csv)"
+)
+
+EXISTING_SQL = """
+SELECT id, name, types, lat, lon FROM places WHERE types = ANY(:types)
+"""
+
+UPDATE_SQL = """
+UPDATE places AS p
+SET lat = s.lat,
+    lon = s.lon,
+    coords = ST_SetSRID(ST_MakePoint(s.lon, s.lat), 4326)::geography,
+    image_url = s.image_url
+FROM places_staging AS s
+WHERE p.id = s.place_id
+  AND (p.lat, p.lon, p.image_url) IS DISTINCT FROM (s.lat, s.lon, s.image_url)
+"""
+
+INSERT_SQL = """
+INSERT INTO places (name, types, lat, lon, coords, image_url, rating_sum, rating_count)
+SELECT s.name, s.types, s.lat, s.lon,
+       ST_SetSRID(ST_MakePoint(s.lon, s.lat), 4326)::geography, s.image_url, 0, 0
+FROM places_staging AS s
+WHERE s.place_id IS NULL
+"""
+
+# Places of the synced types that left the upstream data; the ones with
+# reviews or favorites are kept so no user data is lost
+STALE_SQL = """
+FROM places AS p
+WHERE p.types = ANY(:types)
+  AND NOT EXISTS (SELECT 1 FROM places_staging AS s WHERE s.place_id = p.id)
+"""
+
+DELETE_SQL = f"""
+DELETE FROM places
+WHERE id IN (
+    SELECT p.id {STALE_SQL}
+      AND NOT EXISTS (SELECT 1 FROM reviews AS r WHERE r.place_id = p.id)
+      AND NOT EXISTS (SELECT 1 FROM assoc_favorites AS f WHERE f.place_id = p.id)
+)
+"""
+
+COUNT_STALE_SQL = f"SELECT count(*) {STALE_SQL}"
+
+
+def _dedupe(mdata):
+    """mdata with float coordinates and without repeated places: the last
+    row of each name, types and position rounded to ~1m."""
+    rows = {}
+    for data in mdata:
+        data = dict(data, lat=float(data["lat"]), lon=float(data["lon"]))
+        key = (
+            data["name"],
+            data["types"],
+            round(data["lat"], 5),
+            round(data["lon"], 5),
+        )
+        rows.pop(key, None)
+        rows[key] = data
+    return list(rows.values())
+
+
+def match_places(mdata, existing, tolerance=MOVE_TOLERANCE_M):
+    """The id of the existing place each row of mdata is, or None for new
+    places. Rows and places of the same name and types are paired nearest
+    first, up to `tolerance` meters apart, each place with at most one row,
+    so that moved places keep their id and user data."""
+    places = defaultdict(list)
+    for place in existing:
+        places[(place["name"], place["types"])].append(place)
+
+    pairs = []
+    for index, data in enumerate(mdata):
+        candidates = places.get((data["name"], data["types"]))
+        if not candidates:
+            continue
+        lats = np.radians([place["lat"] for place in candidates])
+        lons = np.radians([place["lon"] for place in candidates])
+        distances = haversine(data["lat"], data["lon"], lats, lons)
+        pairs.extend(
+            (distance, index, place["id"])
+            for distance, place in zip(distances, candidates)
+            if distance <= tolerance
+        )
+
+    matches = [None] * len(mdata)
+    taken = set()
+    for distance, index, place_id in sorted(pairs):
+        if matches[index] is None and place_id not in taken:
+            matches[index] = place_id
+            taken.add(place_id)
+    return matches
+
+
+def _copy_to_staging(mdata, matches):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for data, place_id in zip(mdata, matches):
+        writer.writerow(
+            [
+                place_id,
+                data["name"],
+                data["types"],
+                data["lat"],
+                data["lon"],
+                data["image_url"],
+            ]
+        )
+    buf.seek(0)
+
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(COPY_STAGING_SQL, buf)
+    finally:
+        cursor.close()
+
+
+def sync_places(mdata, dry_run=False):
+    """Makes the places of the types in `mdata` match it, in one transaction.
+
+    Each row is matched to an existing place, see match_places, and bulk
+    loaded with COPY into a staging table: new places are inserted, moved or
+    re-imaged ones updated, and missing ones deleted unless they have
+    reviews or favorites. Returns the counts of each change, and of the
+    missing places kept. With dry_run the changes are rolled back."""
+    types = sorted({data["types"] for data in mdata})
+    mdata = _dedupe(mdata)
+    session = db.session
+    try:
+        session.execute(text(CREATE_STAGING_SQL))
+        existing = session.execute(text(EXISTING_SQL), {"types": types})
+        matches = match_places(mdata, [dict(row) for row in existing])
+        _copy_to_staging(mdata, matches)
+
+        stale = session.execute(text(COUNT_STALE_SQL), {"types": types}).scalar()
+        report = {
+            "updated": session.execute(text(UPDATE_SQL)).rowcount,
+            "inserted": session.execute(text(INSERT_SQL)).rowcount,
+            "deleted": session.execute(text(DELETE_SQL), {"types": types}).rowcount,
+        }
+        report["kept"] = stale - report["deleted"]
+
+        if dry_run or not (
+            report["updated"] or report["inserted"] or report["deleted"]
+        ):
+            session.rollback()
+        else:
+            bump_catalog_version()
+            clear_tiles()
+            session.commit()
+            place_index.clear()
+            search_cache.clear()
+    except Exception:
+        session.rollback()
+        raise
+    return report
@@ -0,0 +1,256 @@
+"""Map tiles of places, served by GET /places/tiles/<z>/<x>/<y>.
+
+Tiles follow the XYZ scheme of web maps: at zoom z the Web Mercator world
+is split into 2^z by 2^z tiles, x counting east from -180 and y counting
+south from ~85.05 degrees. Below CLUSTER_BELOW_ZOOM, and for tiles holding
+more than MAX_TILE_PLACES places, a tile is a grid of clusters with counts
+per type. Otherwise it lists its places.
+
+Rendered tiles are stored, already encoded, in place_tiles, either ahead of
+time by `manage.py warm_tiles` or after a miss. The store runs on a
+connection of its own, so the GET serving a tile stays read-only. Place
+writes delete the tiles containing the place's old and new position in
+their own transaction, so every worker sees the change at once.
+"""
+import logging
+import math
+
+from sqlalchemy import text, tuple_
+from sqlalchemy.exc import SQLAlchemyError
+
+from src import db
+from src.api.places.models import PlaceTile
+from src.api.serializers import dumps
+from src.metrics import cache_lookup
+
+logger = logging.getLogger(__name__)
+
+MAX_ZOOM = 18
+CLUSTER_BELOW_ZOOM = 16
+CLUSTER_GRID = 8  # clusters per tile side
+MAX_TILE_PLACES = 1000
+MAX_MERCATOR_LAT = 85.0511287798
+# how far a point is nudged when looking for the tiles it lies on the edge of
+EDGE_EPSILON_DEG = 1e-7
+# The envelope's edges are great circles on the geography type, which bow
+# away from the box's parallels; padding it by a tenth of the box keeps
+# every point of the box inside for boxes up to 22.5 degrees (zoom 4
+# tiles). Wider boxes scan places.
+INDEX_MAX_SPAN_DEG = 22.5
+ENVELOPE_PADDING = 0.1
+
+# Candidates through the GiST index, then the tile's exact edges: a point
+# belongs to the tile when west <= lon < east and south < lat <= north
+TILE_POINTS_SQL = """
+    SELECT id, name, types, ST_Y(coords::geometry) AS lat, ST_X(coords::geometry) AS lon
+    FROM places
+    WHERE {index_filter}
+"""
+
+INDEX_FILTER = (
+    "coords && ST_MakeEnvelope(:pad_west, :pad_south, :pad_east, :pad_north, 4326)"
+    "::geography"
+)
+
+TILE_PLACES_SQL = """
+SELECT id, name, types, lat, lon
+FROM ({points}) AS p
+WHERE lon >= :west AND lon < :east AND lat > :south AND lat <= :north
+ORDER BY id
+LIMIT :limit
+"""
+
+TILE_CLUSTERS_SQL = """
+SELECT cx, cy, types, count(*) AS count, avg(lat) AS lat, avg(lon) AS lon
+FROM (
+    SELECT types, lat, lon,
+           floor((lon - :west) / (:east - :west) * :grid) AS cx,
+           floor((:north - lat) / (:north - :south) * :grid) AS cy
+    FROM ({points}) AS p
+    WHERE lon >= :west AND lon < :east AND lat > :south AND lat <= :north
+) AS cells
+GROUP BY cx, cy, types
+ORDER BY cy, cx, types
+"""
+
+CATALOG_VERSION_SQL = "SELECT COALESCE(max(version), 0) FROM catalog_version"
+
+# Skipped when the catalog changed since the tile was rendered. Writers
+# bump the version before deleting tiles, so FOR SHARE waits for a write
+# in progress and then sees its new version. Concurrent misses of one tile
+# all try to store it; the first wins.
+STORE_TILE_SQL = """
+INSERT INTO place_tiles (z, x, y, payload, created_at)
+SELECT :z, :x, :y, :payload, now()
+WHERE COALESCE(
+    (SELECT version FROM catalog_version WHERE id = 1 FOR SHARE), 0
+) = :version
+ON CONFLICT DO NOTHING
+"""
+
+
+def valid_tile(z, x, y):
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def tile_bounds(z, x, y):
+    """(south, west, north, east) of a tile, in degrees."""
+    n = 2 ** z
+
+    def lat(tile_y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * tile_y / n))))
+
+    return lat(y + 1), x / n * 360 - 180, lat(y), (x + 1) / n * 360 - 180
+
+
+def tile_for(lat, lon, z):
+    """(x, y) of the tile containing (lat, lon) at zoom z."""
+    n = 2 ** z
+    lat = max(min(lat, MAX_MERCATOR_LAT), -MAX_MERCATOR_LAT)
+    x = int((lon + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tiles_for(lat, lon):
+    """(z, x, y) of every tile that may contain (lat, lon), up to MAX_ZOOM.
+
+    Points within EDGE_EPSILON_DEG of a tile edge also yield the tile on the
+    other side, so rounding differences between this and the SQL edge test
+    can't leave a stale tile behind."""
+    tiles = set()
+    for z in range(MAX_ZOOM + 1):
+        for d_lat in (-EDGE_EPSILON_DEG, 0, EDGE_EPSILON_DEG):
+            for d_lon in (-EDGE_EPSILON_DEG, 0, EDGE_EPSILON_DEG):
+                tiles.add((z,) + tile_for(lat + d_lat, lon + d_lon, z))
+    return tiles
+
+
+def tiles_covering(south, west, north, east, z):
+    """(x, y) of the tiles at zoom z covering a bounding box."""
+    min_x, min_y = tile_for(north, west, z)
+    max_x, max_y = tile_for(south, east, z)
+    for x in range(min_x, max_x + 1):
+        for y in range(min_y, max_y + 1):
+            yield x, y
+
+
+def _tile_query(template, params):
+    index_filter = INDEX_FILTER if "pad_south" in params else "true"
+    return text(
+        template.format(points=TILE_POINTS_SQL.format(index_filter=index_filter))
+    )
+
+
+def padded_envelope(south, west, north, east):
+    """A box around (south, west, north, east) whose geography envelope
+    contains all of it, for && on places.coords. None when the box is too
+    wide for that."""
+    if max(north - south, east - west) > INDEX_MAX_SPAN_DEG:
+        return None
+    pad_lat = (north - south) * ENVELOPE_PADDING
+    pad_lon = (east - west) * ENVELOPE_PADDING
+    return (
+        max(south - pad_lat, -90),
+        max(west - pad_lon, -180),
+        min(north + pad_lat, 90),
+        min(east + pad_lon, 180),
+    )
+
+
+def _tile_params(z, x, y):
+    south, west, north, east = tile_bounds(z, x, y)
+    params = {"south": south, "west": west, "north": north, "east": east}
+    envelope = padded_envelope(south, west, north, east)
+    if envelope is not None:
+        keys = ("pad_south", "pad_west", "pad_north", "pad_east")
+        params.update(zip(keys, envelope))
+    return params
+
+
+def _clusters(params):
+    cells = {}
+    statement = _tile_query(TILE_CLUSTERS_SQL, params)
+    for row in db.session.execute(statement, params):
+        cell = cells.setdefault(
+            (row.cy, row.cx), {"lat": 0.0, "lon": 0.0, "count": 0, "types": {}}
+        )
+        # count-weighted centroid of the cell's types
+        cell["lat"] += row.lat * row.count
+        cell["lon"] += row.lon * row.count
+        cell["count"] += row.count
+        cell["types"][row.types] = row.count
+
+    clusters = []
+    for _, cell in sorted(cells.items()):
+        cell["lat"] /= cell["count"]
+        cell["lon"] /= cell["count"]
+        clusters.append(cell)
+    return clusters
+
+
+def render_tile(z, x, y):
+    """The tile's payload: its places, or clusters of them when there are
+    too many to show."""
+    params = _tile_params(z, x, y)
+    payload = {"z": z, "x": x, "y": y, "clustered": True, "places": [], "clusters": []}
+
+    if z >= CLUSTER_BELOW_ZOOM:
+        rows = db.session.execute(
+            _tile_query(TILE_PLACES_SQL, params),
+            dict(params, limit=MAX_TILE_PLACES + 1),
+        ).fetchall()
+        if len(rows) <= MAX_TILE_PLACES:
+            payload["clustered"] = False
+            payload["places"] = [dict(row) for row in rows]
+            return payload
+
+    payload["clusters"] = _clusters(dict(params, grid=CLUSTER_GRID))
+    return payload
+
+
+def store_tile(z, x, y, payload, version):
+    """Stores a rendered tile in a short transaction on a primary connection
+    of its own, outside the caller's session. Failures are logged: the tile
+    is simply rendered again on the next miss."""
+    params = {"z": z, "x": x, "y": y, "payload": payload, "version": version}
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(text(STORE_TILE_SQL), params)
+    except SQLAlchemyError as e:
+        logger.warning("Storing tile %s/%s/%s failed: %s", z, x, y, e)
+
+
+def get_tile(z, x, y):
+    """The tile's payload as encoded JSON, rendered on a miss. Only reads
+    through the session; see store_tile."""
+    payload = (
+        db.session.query(PlaceTile.payload)
+        .filter(PlaceTile.z == z, PlaceTile.x == x, PlaceTile.y == y)
+        .scalar()
+    )
+    cache_lookup("tiles", "miss" if payload is None else "hit")
+    if payload is not None:
+        return payload
+
+    version = db.session.execute(text(CATALOG_VERSION_SQL)).scalar()
+    payload = dumps(render_tile(z, x, y)).decode("utf-8")
+    store_tile(z, x, y, payload, version)
+    return payload
+
+
+def invalidate_tiles(lat, lon):
+    """Deletes the stored tiles containing (lat, lon). Call inside the
+    writing transaction, after bump_catalog_version."""
+    if lat is None or lon is None:
+        return
+    key = tuple_(PlaceTile.z, PlaceTile.x, PlaceTile.y)
+    db.session.execute(
+        PlaceTile.__table__.delete().where(key.in_(sorted(tiles_for(lat, lon))))
+    )
+
+
+def clear_tiles():
+    """Deletes every stored tile, for bulk place writes. Call inside the
+    writing transaction, after bump_catalog_version."""
+    db.session.execute(PlaceTile.__table__.delete())
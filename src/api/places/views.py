@@ -1,16 +1,35 @@
-from flask import request
-from flask_restx import Namespace, Resource, fields, reqparse
+from flask import Response, request
+from flask_restx import Namespace, Resource, fields, reqparse, marshal
+
+from src.api.places.conditional import (
+    catalog_conditional,
+    place_conditional,
+    ratings_conditional,
+)
+from src.api.pagination import (
+    add_pagination_arguments,
+    next_page_headers,
+    stream_response,
+)
+from src.api.places.search_cache import search_cache
+from src.api.places.tiles import MAX_ZOOM, get_tile, valid_tile
+from src.api.serializers import ListSerializer, json_response
 
 
 from src.api.places.crud import (  # isort:skip
-    get_all_places,
+    get_places_page,
+    get_places_in_bbox,
+    stream_places,
     get_place_by_id,
     get_place_by_name,
     add_place,
     update_place,
     delete_place,
     get_knearest_places,
+    get_knearest_places_batch,
     get_rating_by_id,
+    get_ratings_by_ids,
+    get_top_places,
 )
 
 places_namespace = Namespace("places")
@@ -25,15 +44,111 @@ place = places_namespace.model(
         "lat": fields.Float(required=True),
         "lon": fields.Float(required=True),
         "image_url": fields.String(),
+        "rating": fields.Integer(readOnly=True),
+    },
+)
+
+search_query = places_namespace.model(
+    "Place search",
+    {
+        "lat": fields.Float(),
+        "lon": fields.Float(),
+        "types": fields.String(required=True),
+        "m": fields.Integer(),
+        "k": fields.Integer(),
+    },
+)
+
+search_batch = places_namespace.model(
+    "Place search batch",
+    {"queries": fields.List(fields.Nested(search_query), required=True)},
+)
+
+tile_place = places_namespace.model(
+    "Tile place",
+    {
+        "id": fields.Integer,
+        "name": fields.String,
+        "types": fields.String,
+        "lat": fields.Float,
+        "lon": fields.Float,
+    },
+)
+
+tile_cluster = places_namespace.model(
+    "Tile cluster",
+    {
+        "lat": fields.Float,
+        "lon": fields.Float,
+        "count": fields.Integer,
+        "types": fields.Raw(description="Count of places per type"),
+    },
+)
+
+tile = places_namespace.model(
+    "Tile",
+    {
+        "z": fields.Integer,
+        "x": fields.Integer,
+        "y": fields.Integer,
+        "clustered": fields.Boolean,
+        "places": fields.List(fields.Nested(tile_place)),
+        "clusters": fields.List(fields.Nested(tile_cluster)),
+    },
+)
+
+bbox_result = places_namespace.model(
+    "Places in bbox",
+    {
+        "places": fields.List(fields.Nested(place)),
+        "truncated": fields.Boolean(
+            description="More places matched than limit, zoom in to see them all"
+        ),
+    },
+)
+
+bbox_parser = reqparse.RequestParser()
+bbox_parser.add_argument("west", type=float, required=True)
+bbox_parser.add_argument("south", type=float, required=True)
+bbox_parser.add_argument("east", type=float, required=True)
+bbox_parser.add_argument("north", type=float, required=True)
+bbox_parser.add_argument("types", required=False)
+bbox_parser.add_argument("limit", type=int, required=False)
+
+place_serializer = ListSerializer(place)
+
+MAX_BATCH_QUERIES = 100
+MAX_RATING_IDS = 500
+MAX_TOP_PLACES = 100
+DEFAULT_BBOX_LIMIT = 500
+MAX_BBOX_LIMIT = 2000
+
+top_place = places_namespace.inherit(
+    "Top place",
+    place,
+    {
+        "score": fields.Float(readOnly=True),
+        "rating_count": fields.Integer(readOnly=True),
     },
 )
 
 
 class PlacesList(Resource):
-    @places_namespace.marshal_with(place, as_list=True)
+    @ratings_conditional
+    @places_namespace.expect(add_pagination_arguments())
+    @places_namespace.response(200, "Success", [place])
     def get(self):
-        """Returns all places."""
-        return get_all_places(), 200
+        """Returns all places, or one page of them given limit/cursor."""
+        args = add_pagination_arguments().parse_args()
+        columns = place_serializer.fields
+        if args.get("stream"):
+            places = stream_places(args.get("cursor"), args.get("limit"), columns)
+            return stream_response(places, place_serializer.one, args["stream"])
+
+        places, next_cursor = get_places_page(
+            args.get("cursor"), args.get("limit"), columns
+        )
+        return place_serializer.response(places, 200, next_page_headers(next_cursor))
 
     @places_namespace.expect(place, validate=True)
     @places_namespace.response(201, "<place_name> was added!")
@@ -53,13 +168,15 @@ class PlacesList(Resource):
             response_object["message"] = "Sorry. That place already exists."
             return response_object, 400
 
-        add_place(lat, lon, name, types, image_url)
+        place = add_place(lat, lon, name, types, image_url)
 
         response_object["message"] = f"{name} was added!"
-        return response_object, 201
+        response_object["id"] = place.id
+        return response_object, 201, {"Location": f"{request.base_url}/{place.id}"}
 
 
 class Places(Resource):
+    @place_conditional
     @places_namespace.marshal_with(place)
     @places_namespace.response(200, "Success")
     @places_namespace.response(404, "Place <place_name> does not exist")
@@ -114,7 +231,7 @@ class Places(Resource):
 
 
 class PlacesSearches(Resource):
-    @places_namespace.marshal_with(place, as_list=True)
+    @places_namespace.response(200, "Success", [place])
     def get(self, place_types):
         """Return nearby places of specific type."""
         parser = reqparse.RequestParser()
@@ -137,25 +254,164 @@ class PlacesSearches(Resource):
             k = -1
         # print(lat, lon, place_types, m, k)
 
-        res = get_knearest_places(lat, lon, place_types, m, k)
+        res = get_knearest_places(
+            lat, lon, place_types, m, k, fields=place_serializer.fields
+        )
 
-        return res, 200
+        return place_serializer.response(res, 200)
+
+
+class PlacesSearchBatch(Resource):
+    @places_namespace.expect(search_batch, validate=True)
+    @places_namespace.response(200, "Success")
+    @places_namespace.response(400, "Too many queries in one batch.")
+    def post(self):
+        """Return nearby places for many origins, keyed by query index."""
+        queries = request.get_json().get("queries")
+        response_object = {}
+
+        if len(queries) > MAX_BATCH_QUERIES:
+            response_object[
+                "message"
+            ] = f"At most {MAX_BATCH_QUERIES} queries are allowed in one batch."
+            return response_object, 400
+
+        res = get_knearest_places_batch(queries)
+
+        return json_response(
+            {
+                "results": {
+                    str(idx): place_serializer.items(places)
+                    for idx, places in res.items()
+                }
+            },
+            200,
+        )
+
+
+class PlacesSearchCache(Resource):
+    @places_namespace.response(200, "Success")
+    def get(self):
+        """Returns this worker's nearby-search cache hit rate and timings."""
+        return search_cache.stats(), 200
+
+
+class PlacesBbox(Resource):
+    @ratings_conditional
+    @places_namespace.expect(bbox_parser)
+    @places_namespace.response(200, "Success", bbox_result)
+    @places_namespace.response(400, "Invalid bounding box.")
+    def get(self):
+        """Returns the places inside a map viewport, at most limit of them."""
+        args = bbox_parser.parse_args()
+        south, west, north, east = (
+            args["south"],
+            args["west"],
+            args["north"],
+            args["east"],
+        )
+        if not (-90 <= south <= north <= 90 and -180 <= west <= east <= 180):
+            return {
+                "message": "Invalid bounding box. Expected -90 <= south <= north <= 90 "
+                "and -180 <= west <= east <= 180."
+            }, 400
+        limit = args.get("limit") or DEFAULT_BBOX_LIMIT
+        limit = min(max(limit, 1), MAX_BBOX_LIMIT)
+
+        places, truncated = get_places_in_bbox(
+            south,
+            west,
+            north,
+            east,
+            args.get("types"),
+            limit,
+            fields=place_serializer.fields,
+        )
+        return json_response(
+            {"places": place_serializer.items(places), "truncated": truncated}, 200
+        )
+
+
+class PlacesTile(Resource):
+    @catalog_conditional
+    @places_namespace.response(200, "Success", tile)
+    @places_namespace.response(404, "Tile <z>/<x>/<y> does not exist")
+    def get(self, z, x, y):
+        """Returns the places of a map tile, or clusters of them when zoomed out."""
+        if not valid_tile(z, x, y):
+            places_namespace.abort(
+                404, f"Tile {z}/{x}/{y} does not exist (zoom 0 to {MAX_ZOOM})"
+            )
+        return Response(get_tile(z, x, y) + "\n", mimetype="application/json")
+
+
+class PlacesTop(Resource):
+    @ratings_conditional
+    @places_namespace.response(200, "Success", [top_place])
+    def get(self, place_types):
+        """Returns the best rated places of a type, by Bayesian average rating."""
+        parser = reqparse.RequestParser()
+        parser.add_argument("k", type=int, required=False)
+        parser.add_argument("min_reviews", type=int, required=False)
+        args = parser.parse_args()
+        k = args.get("k")
+        if k is None or k <= 0:
+            k = 10
+        min_reviews = args.get("min_reviews") or 0
+
+        res = []
+        for pl, score in get_top_places(
+            place_types, min(k, MAX_TOP_PLACES), min_reviews
+        ):
+            pl.score = score
+            res.append(pl)
+        return marshal(res, top_place), 200
 
 
 class PlaceRating(Resource):
+    @place_conditional
     def get(self, place_id):
         """Returns average rating for given place id. 0 if there are no ratings."""
-        place = get_place_by_id(place_id)
-
-        if not place:
-            places_namespace.abort(404, f"Place {place_id} does not exist")
         rating = get_rating_by_id(place_id)
+
         if rating is None:
-            rating = 0
-        return {"rating": int(rating)}, 200
+            places_namespace.abort(404, f"Place {place_id} does not exist")
+        return {"rating": rating}, 200
+
+
+class PlacesRatings(Resource):
+    @places_namespace.response(200, "Success")
+    @places_namespace.response(400, "Supply a comma separated list of place ids.")
+    def get(self):
+        """Returns average ratings for many place ids, keyed by place id."""
+        parser = reqparse.RequestParser()
+        parser.add_argument("ids", type=int, action="split", required=False)
+        args = parser.parse_args()
+        place_ids = args.get("ids")
+        response_object = {}
+
+        if not place_ids:
+            response_object["message"] = "Supply a comma separated list of place ids."
+            return response_object, 400
+        if len(place_ids) > MAX_RATING_IDS:
+            response_object[
+                "message"
+            ] = f"At most {MAX_RATING_IDS} place ids are allowed in one request."
+            return response_object, 400
+
+        ratings = get_ratings_by_ids(place_ids)
+        return {
+            "ratings": {str(place_id): rating for place_id, rating in ratings.items()}
+        }, 200
 
 
 places_namespace.add_resource(PlacesList, "")
 places_namespace.add_resource(Places, "/<int:place_id>")
 places_namespace.add_resource(PlacesSearches, "/<string:place_types>")
+places_namespace.add_resource(PlacesSearchBatch, "/search/batch")
+places_namespace.add_resource(PlacesSearchCache, "/search/cache")
+places_namespace.add_resource(PlacesBbox, "/bbox")
+places_namespace.add_resource(PlacesTile, "/tiles/<int:z>/<int:x>/<int:y>")
+places_namespace.add_resource(PlacesTop, "/<string:place_types>/top")
 places_namespace.add_resource(PlaceRating, "/rating/<int:place_id>")
+places_namespace.add_resource(PlacesRatings, "/ratings")
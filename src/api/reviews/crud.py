@@ -1,42 +1,212 @@
-from src import db
-from src.api.reviews.models import Review
-
+from sqlalchemy import Numeric, and_, cast, func, or_, text
 
+from src import db
+from src.api.pagination import keyset_page, keyset_stream
+from src.api.places.crud import refresh_place_index
+from src.api.places.models import Place
+from src.api.reviews.models import (
+    TSVECTOR_SQL,
+    Review,
+    search_config,
+    text_search_vector,
+)
+from src.replicas import replica_reads
+
+# ts_headline options: the matches of each snippet are wrapped in <mark>
+HEADLINE_OPTIONS = "StartSel=<mark>, StopSel=</mark>, MaxWords=35, MinWords=15"
+# & first, so that the entities of the others aren't escaped again
+HTML_ESCAPES = (
+    ("&", "&amp;"),
+    ("<", "&lt;"),
+    (">", "&gt;"),
+    ('"', "&quot;"),
+    ("'", "&#39;"),
+)
+
+
+def _html_escaped(column):
+    for char, entity in HTML_ESCAPES:
+        column = func.replace(column, char, entity)
+    return column
+
+
+def _adjust_place_rating(place_id, rating_delta, count_delta):
+    # Runs inside the caller's transaction, as a single atomic UPDATE of the
+    # place's row only, so that reviews of different places don't contend
+    Place.query.filter_by(id=place_id).update(
+        {
+            Place.rating_sum: Place.rating_sum + rating_delta,
+            Place.rating_count: Place.rating_count + count_delta,
+            Place.rating_updated_at: func.clock_timestamp(),
+        },
+        synchronize_session=False,
+    )
+
+
+@replica_reads
 def get_all_reviews():
     return Review.query.all()
 
 
+def _filter_reviews(user_id=None, place_id=None, fields=None):
+    # with `fields`, row tuples of those Review columns instead of entities
+    if fields is None:
+        query = Review.query
+    else:
+        query = db.session.query(*[getattr(Review, field) for field in fields])
+    if user_id is not None:
+        query = query.filter(Review.user_id == user_id)
+    if place_id is not None:
+        query = query.filter(Review.place_id == place_id)
+    return query
+
+
+@replica_reads
+def get_reviews_page(user_id=None, place_id=None, cursor=None, limit=None, fields=None):
+    query = _filter_reviews(user_id, place_id, fields)
+    return keyset_page(query, Review.id, cursor, limit)
+
+
+@replica_reads
+def stream_reviews(user_id=None, place_id=None, cursor=None, limit=None, fields=None):
+    query = _filter_reviews(user_id, place_id, fields)
+    return keyset_stream(query, Review.id, cursor, limit)
+
+
 def get_review_by_id(review_id):
     return Review.query.filter_by(id=review_id).first()
 
 
+@replica_reads
 def get_reviews_by_place(place_id):
     return Review.query.filter_by(place_id=place_id).all()
 
 
+@replica_reads
 def get_reviews_by_user(user_id):
     return Review.query.filter_by(user_id=user_id).all()
 
 
+@replica_reads
 def get_reviews_composite(user_id, place_id):
     return Review.query.filter_by(user_id=user_id, place_id=place_id).all()
 
 
+@replica_reads
+def search_reviews(q, place_id=None, types=None, cursor=None, limit=20):
+    """Reviews whose text contains all the words of `q`, best first, as
+    (hits, next_cursor).
+
+    Hits are rows with the review's columns, its ts_rank and a highlighted
+    headline. Matches come from the GIN index on reviews.text_tsv; every
+    match is ranked, then only the page's rows get a headline. The headline
+    is HTML: the review text is escaped before ts_headline adds the <mark>
+    tags, so those are its only markup. Pages are
+    keyset paginated on (rank, id): cursor and next_cursor are (rank, id)
+    of the last hit, next_cursor None on the last page. The rank is a
+    numeric so that it survives the round trip through the cursor."""
+    tsquery = func.plainto_tsquery(search_config(), q)
+    rank = cast(func.ts_rank(Review.text_tsv, tsquery), Numeric)
+    hits = db.session.query(Review.id.label("id"), rank.label("rank")).filter(
+        Review.text_tsv.op("@@")(tsquery)
+    )
+    if place_id is not None:
+        hits = hits.filter(Review.place_id == place_id)
+    if types is not None:
+        hits = hits.join(Place, Place.id == Review.place_id).filter(
+            Place.types == types
+        )
+    if cursor is not None:
+        after_rank, after_id = cursor
+        hits = hits.filter(
+            or_(rank < after_rank, and_(rank == after_rank, Review.id > after_id))
+        )
+    hits = hits.order_by(rank.desc(), Review.id).limit(limit + 1).subquery()
+
+    headline = func.ts_headline(
+        search_config(), _html_escaped(Review.text), tsquery, HEADLINE_OPTIONS
+    )
+    rows = (
+        db.session.query(
+            Review.id,
+            Review.user_id,
+            Review.place_id,
+            Review.rating,
+            Review.text,
+            Review.created_date,
+            hits.c.rank,
+            headline.label("headline"),
+        )
+        .join(hits, hits.c.id == Review.id)
+        .order_by(hits.c.rank.desc(), Review.id)
+        .all()
+    )
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, (rows[-1].rank, rows[-1].id)
+
+
+BACKFILL_SEARCH_SQL = f"""
+UPDATE reviews
+SET text_tsv = {TSVECTOR_SQL.format(text="text")}
+WHERE id IN (
+    SELECT id FROM reviews WHERE id > :after_id ORDER BY id LIMIT :batch_size
+)
+AND text_tsv IS NULL
+"""
+
+NEXT_BATCH_SQL = """
+SELECT max(id) FROM (
+    SELECT id FROM reviews WHERE id > :after_id ORDER BY id LIMIT :batch_size
+) AS batch
+"""
+
+
+def backfill_review_search(batch_size=10000, echo=None):
+    """Fills reviews.text_tsv where it is NULL, walking the table by id in
+    batches of `batch_size` rows, each its own short transaction, so writes
+    to reviews are never blocked for long. Returns the rows updated."""
+    updated = 0
+    after_id = 0
+    while True:
+        params = {"after_id": after_id, "batch_size": batch_size}
+        last_id = db.session.execute(text(NEXT_BATCH_SQL), params).scalar()
+        if last_id is None:
+            break
+        updated += db.session.execute(text(BACKFILL_SEARCH_SQL), params).rowcount
+        db.session.commit()
+        after_id = last_id
+        if echo is not None:
+            echo(f"up to review {after_id}: {updated} updated")
+    db.session.commit()
+    return updated
+
+
 def add_review(user_id, place_id, rating, text):
     review = Review(user_id=user_id, place_id=place_id, rating=rating, text=text)
+    review.text_tsv = text_search_vector(text)
     db.session.add(review)
+    _adjust_place_rating(place_id, rating, 1)
     db.session.commit()
+    refresh_place_index(place_id)
     return review
 
 
 def update_review(review, rating, text):
+    if rating is not None and rating != review.rating:
+        _adjust_place_rating(review.place_id, rating - review.rating, 0)
     review.rating = rating
     review.text = text
+    review.text_tsv = text_search_vector(text)
     db.session.commit()
+    refresh_place_index(review.place_id)
     return review
 
 
 def delete_review(review):
+    _adjust_place_rating(review.place_id, -review.rating, -1)
     db.session.delete(review)
     db.session.commit()
+    refresh_place_index(review.place_id)
     return review
@@ -0,0 +1,236 @@
+"""Bulk review import, see `manage.py import_reviews`.
+
+Rows are read from CSV (with a header) or NDJSON, one at a time, with the
+fields user_id, place_id, rating, text and optionally created_date (ISO
+8601). Valid rows are COPYed in batches into a staging table; rows with
+unknown users or places are then dropped with one query each, and the
+rest merged into reviews together with the places' rating aggregates, in
+one transaction. Importing a file again skips the rows already imported,
+dated or not, see REVIEW_KEY.
+"""
+import csv
+import datetime
+import io
+import json
+import time
+
+from sqlalchemy import text
+
+from src import db
+from src.api.places.engine import place_index
+from src.api.places.search_cache import search_cache
+from src.api.reviews.models import TSVECTOR_SQL
+
+BATCH_SIZE = 50000
+MAX_REPORTED_ERRORS = 20
+MIN_RATING, MAX_RATING = 0, 5
+
+CREATE_STAGING_SQL = """
+CREATE TEMP TABLE reviews_staging (
+    line integer NOT NULL,
+    user_id integer NOT NULL,
+    place_id integer NOT NULL,
+    rating integer NOT NULL,
+    text varchar,
+    created_date timestamp
+) ON COMMIT DROP
+"""
+
+COPY_STAGING_SQL = (
+    "COPY reviews_staging (line, user_id, place_id, rating, text, created_date) "
+    "FROM STDIN WITH (FORMAT csv)"
+)
+
+UNKNOWN_USERS_SQL = """
+DELETE FROM reviews_staging AS s
+WHERE NOT EXISTS (SELECT 1 FROM users AS u WHERE u.id = s.user_id)
+RETURNING s.line
+"""
+
+UNKNOWN_PLACES_SQL = """
+DELETE FROM reviews_staging AS s
+WHERE NOT EXISTS (SELECT 1 FROM places AS p WHERE p.id = s.place_id)
+RETURNING s.line
+"""
+
+# Same user, place and text: with the same created_date (or none) it is a
+# repeated line of the file, and with the same created_date as a review, or
+# none at all, a row an earlier run of the same file already imported.
+# Undated rows get the import time as their date, so a re-run can't tell
+# them by date: an undated row is skipped when the user already has a
+# review of the place with the same text.
+REVIEW_KEY = """
+    {a}.user_id = {b}.user_id AND {a}.place_id = {b}.place_id
+    AND {a}.text IS NOT DISTINCT FROM {b}.text
+"""
+
+DEDUPE_STAGING_SQL = f"""
+DELETE FROM reviews_staging AS a
+USING reviews_staging AS b
+WHERE a.line > b.line AND {REVIEW_KEY.format(a="a", b="b")}
+  AND a.created_date IS NOT DISTINCT FROM b.created_date
+"""
+
+MERGE_SQL = f"""
+WITH inserted AS (
+    INSERT INTO reviews (user_id, place_id, created_date, rating, text, text_tsv)
+    SELECT s.user_id, s.place_id, COALESCE(s.created_date, now()), s.rating, s.text,
+           {TSVECTOR_SQL.format(text="s.text")}
+    FROM reviews_staging AS s
+    WHERE NOT EXISTS (
+        SELECT 1 FROM reviews AS r
+        WHERE {REVIEW_KEY.format(a="r", b="s")}
+          AND (s.created_date IS NULL OR r.created_date = s.created_date)
+    )
+    RETURNING place_id, rating
+), totals AS (
+    SELECT place_id, SUM(rating) AS rating_sum, COUNT(*) AS rating_count
+    FROM inserted
+    GROUP BY place_id
+), updated AS (
+    UPDATE places AS p
+    SET rating_sum = p.rating_sum + t.rating_sum,
+        rating_count = p.rating_count + t.rating_count,
+        rating_updated_at = clock_timestamp()
+    FROM totals AS t
+    WHERE p.id = t.place_id
+    RETURNING p.id
+)
+SELECT (SELECT COUNT(*) FROM inserted) AS inserted,
+       (SELECT COUNT(*) FROM updated) AS places
+"""
+
+
+class InvalidRow(ValueError):
+    pass
+
+
+def _integer(record, key):
+    value = record.get(key)
+    if value is None or value == "":
+        raise InvalidRow(f"missing {key}")
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise InvalidRow(f"{key} is not a number: {value!r}")
+    if not number.is_integer():
+        raise InvalidRow(f"{key} is not an integer: {value!r}")
+    return int(number)
+
+
+def parse_row(record):
+    """(user_id, place_id, rating, text, created_date) of an input record."""
+    user_id = _integer(record, "user_id")
+    place_id = _integer(record, "place_id")
+    rating = _integer(record, "rating")
+    if not MIN_RATING <= rating <= MAX_RATING:
+        raise InvalidRow(
+            f"rating {rating} is not between {MIN_RATING} and {MAX_RATING}"
+        )
+
+    created_date = record.get("created_date") or None
+    if created_date is not None:
+        try:
+            created_date = datetime.datetime.fromisoformat(created_date).isoformat()
+        except (TypeError, ValueError):
+            raise InvalidRow(f"created_date is not ISO 8601: {created_date!r}")
+    return user_id, place_id, rating, record.get("text") or None, created_date
+
+
+def read_records(f, fmt):
+    """(line number, record dict) of every row of a CSV or NDJSON file."""
+    if fmt == "csv":
+        reader = csv.DictReader(f)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for line, raw in enumerate(f, start=1):
+        if not raw.strip():
+            continue
+        try:
+            record = json.loads(raw)
+        except ValueError as e:
+            yield line, InvalidRow(f"invalid JSON: {e}")
+            continue
+        if not isinstance(record, dict):
+            record = InvalidRow("not a JSON object")
+        yield line, record
+
+
+def _copy_batch(rows):
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    buf.seek(0)
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(COPY_STAGING_SQL, buf)
+    finally:
+        cursor.close()
+
+
+def import_reviews(f, fmt="csv", dry_run=False, batch_size=BATCH_SIZE):
+    """Imports the reviews of an open CSV or NDJSON file, in one transaction.
+
+    Returns a report with the rows read, the rows rejected as invalid or for
+    unknown users or places, duplicates skipped, reviews inserted, places
+    whose rating changed, the first MAX_REPORTED_ERRORS errors and the
+    throughput. With dry_run the import is rolled back."""
+    started = time.perf_counter()
+    report = {"read": 0, "invalid": 0, "errors": []}
+
+    def reject(line, reason):
+        report["invalid"] += 1
+        if len(report["errors"]) < MAX_REPORTED_ERRORS:
+            report["errors"].append(f"line {line}: {reason}")
+
+    session = db.session
+    try:
+        session.execute(text(CREATE_STAGING_SQL))
+        batch = []
+        for line, record in read_records(f, fmt):
+            report["read"] += 1
+            if isinstance(record, InvalidRow):
+                reject(line, record)
+                continue
+            try:
+                batch.append((line,) + parse_row(record))
+            except InvalidRow as e:
+                reject(line, e)
+                continue
+            if len(batch) >= batch_size:
+                _copy_batch(batch)
+                batch = []
+        if batch:
+            _copy_batch(batch)
+        session.execute(text("ANALYZE reviews_staging"))
+
+        for key, statement in (
+            ("unknown_user", UNKNOWN_USERS_SQL),
+            ("unknown_place", UNKNOWN_PLACES_SQL),
+        ):
+            lines = [row[0] for row in session.execute(text(statement))]
+            report[key] = len(lines)
+            for line in sorted(lines)[: MAX_REPORTED_ERRORS - len(report["errors"])]:
+                report["errors"].append(f"line {line}: {key.replace('_', ' ')}")
+
+        staged_duplicates = session.execute(text(DEDUPE_STAGING_SQL)).rowcount
+        staged = session.execute(text("SELECT COUNT(*) FROM reviews_staging")).scalar()
+        merged = session.execute(text(MERGE_SQL)).first()
+        report["inserted"] = merged.inserted
+        report["places"] = merged.places
+        report["duplicates"] = staged_duplicates + staged - merged.inserted
+
+        if dry_run or not merged.inserted:
+            session.rollback()
+        else:
+            session.commit()
+            # place payloads include the rating
+            place_index.clear()
+            search_cache.clear()
+    except Exception:
+        session.rollback()
+        raise
+
+    report["seconds"] = time.perf_counter() - started
+    report["rows_per_second"] = report["read"] / report["seconds"]
+    return report
@@ -1,30 +1,44 @@
-import os
-
+from sqlalchemy import literal_column
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import deferred
 from sqlalchemy.sql import func
 
 from src import db
 
+# text search configuration of reviews.text_tsv and its queries
+SEARCH_CONFIG = "english"
+TSVECTOR_SQL = f"to_tsvector('{SEARCH_CONFIG}', COALESCE({{text}}, ''))"
+
+
+def search_config():
+    return literal_column(f"'{SEARCH_CONFIG}'::regconfig")
+
+
+def text_search_vector(text):
+    """The reviews.text_tsv of a review text, as a SQL expression."""
+    return func.to_tsvector(search_config(), func.coalesce(text, ""))
+
 
 class Review(db.Model):
 
     __tablename__ = "reviews"
+    __table_args__ = (
+        db.Index("ix_reviews_text_tsv", "text_tsv", postgresql_using="gin"),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
-    place_id = db.Column(db.Integer, db.ForeignKey("places.id"), nullable=False)
+    place_id = db.Column(
+        db.Integer, db.ForeignKey("places.id"), nullable=False, index=True
+    )
     created_date = db.Column(db.DateTime, default=func.now(), nullable=False)
     rating = db.Column(db.Integer, nullable=False)
     text = db.Column(db.String, nullable=True)
+    # set with text on every write, NULL until backfilled on older rows
+    text_tsv = deferred(db.Column(TSVECTOR, nullable=True))
 
     def __init__(self, **kwargs):
         self.user_id = kwargs.get("user_id")
         self.place_id = kwargs.get("place_id")
         self.rating = kwargs.get("rating")
         self.text = kwargs.get("text")
-
-
-if os.getenv("FLASK_ENV") == "development":
-    from src import admin
-    from src.api.reviews.admin import ReviewsAdminView
-
-    admin.add_view(ReviewsAdminView(Review, db.session))
@@ -1,15 +1,21 @@
+from decimal import Decimal, InvalidOperation
+
 from flask import request
-from flask_restx import Namespace, Resource, fields, reqparse, marshal
-from src.api.users.views import extract_token
-from src.api.users.crud import get_user_by_session_token
+from flask_restx import Namespace, Resource, fields, marshal, reqparse
+from src.api.pagination import (
+    add_pagination_arguments,
+    next_page_headers,
+    stream_response,
+)
+from src.api.serializers import ListSerializer
+from src.api.users.auth import session_required
 
 
 from src.api.reviews.crud import (
-    get_all_reviews,
     get_review_by_id,
-    get_reviews_by_place,
-    get_reviews_by_user,
-    get_reviews_composite,
+    get_reviews_page,
+    stream_reviews,
+    search_reviews,
     add_review,
     update_review,
     delete_review,
@@ -38,44 +44,78 @@ review_fields = {
     "created_date": fields.DateTime,
 }
 
+review_serializer = ListSerializer(review)
+
+review_hit = reviews_namespace.model(
+    "ReviewHit",
+    {
+        "id": fields.Integer(readOnly=True),
+        "user_id": fields.Integer,
+        "place_id": fields.Integer,
+        "rating": fields.Integer,
+        "text": fields.String,
+        "created_date": fields.DateTime,
+        "rank": fields.Float,
+        "headline": fields.String(
+            description="HTML excerpt: the escaped text, matches in <mark>"
+        ),
+    },
+)
+
+review_hit_serializer = ListSerializer(review_hit)
+
+reviews_parser = add_pagination_arguments()
+reviews_parser.add_argument("user", type=int, required=False)
+reviews_parser.add_argument("place", type=int, required=False)
+
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+
+search_parser = reqparse.RequestParser()
+search_parser.add_argument("q", type=str, required=True, help="words to look for")
+search_parser.add_argument("place", type=int, required=False)
+search_parser.add_argument("types", type=str, required=False)
+search_parser.add_argument("limit", type=int, required=False)
+search_parser.add_argument(
+    "cursor", type=str, required=False, help="X-Next-Cursor of the previous page"
+)
+
+
+def parse_search_cursor(cursor):
+    """(rank, id) of a "<rank>:<id>" cursor, None if it is malformed."""
+    rank, _, review_id = cursor.partition(":")
+    try:
+        return Decimal(rank), int(review_id)
+    except (InvalidOperation, ValueError):
+        return None
+
 
 class ReviewsList(Resource):
-    @reviews_namespace.marshal_with(review, as_list=True)
+    @reviews_namespace.expect(reviews_parser)
+    @reviews_namespace.response(200, "Success", [review])
     def get(self):
         """Return query result on reviews based on place/user id"""
-        parser = reqparse.RequestParser()
-        parser.add_argument("user", type=int, required=False)
-        parser.add_argument("place", type=int, required=False)
-        args = parser.parse_args()
+        args = reviews_parser.parse_args()
         user_id = args.get("user")
         place_id = args.get("place")
-        if user_id is None and place_id is None:
-            reviews = get_all_reviews()
-        elif user_id is None:
-            reviews = get_reviews_by_place(place_id)
-        elif place_id is None:
-            print(user_id)
-            reviews = get_reviews_by_user(user_id)
-        else:
-            reviews = get_reviews_composite(user_id=user_id, place_id=place_id)
-        return (reviews, [])[reviews is None]
+        cursor = args.get("cursor")
+        limit = args.get("limit")
+        columns = review_serializer.fields
+        if args.get("stream"):
+            reviews = stream_reviews(user_id, place_id, cursor, limit, columns)
+            return stream_response(reviews, review_serializer.one, args["stream"])
+
+        reviews, next_cursor = get_reviews_page(
+            user_id, place_id, cursor, limit, columns
+        )
+        return review_serializer.response(reviews, 200, next_page_headers(next_cursor))
 
     @reviews_namespace.response(200, "Review updated successfully!")
     @reviews_namespace.response(400, "Request body malformed.")
     @reviews_namespace.response(400, "Invalid rating value.")
-    def post(self):
+    @session_required
+    def post(self, user):
         """Creates a new review."""
-        # Extract token
-        was_successful, session_token = extract_token(request)
-        response_object = {}
-        if not was_successful:
-            response_object["message"] = session_token
-            return response_object, 400
-        # Check token validity
-        user = get_user_by_session_token(session_token)
-        if user is None:
-            response_object["message"] = "Invalid Token."
-            return response_object, 400
         # Create / validate Review object
         user_id = user.id
         post_data = request.get_json()
@@ -91,9 +131,37 @@ class ReviewsList(Resource):
             response_object["message"] = "Request body malformed."
             return response_object, 400
         else:
-            add_review(user_id, place_id, rating, text)
+            review = add_review(user_id, place_id, rating, text)
             response_object["message"] = "Review posted successfully!"
-            return response_object, 201
+            response_object["id"] = review.id
+            return (
+                response_object,
+                201,
+                {"Location": f"{request.base_url}/{review.id}"},
+            )
+
+
+class ReviewsSearch(Resource):
+    @reviews_namespace.expect(search_parser)
+    @reviews_namespace.response(200, "Success", [review_hit])
+    @reviews_namespace.response(400, "Invalid cursor.")
+    def get(self):
+        """Searches review text, best matches first, with highlighted excerpts."""
+        args = search_parser.parse_args()
+        limit = args.get("limit") or DEFAULT_SEARCH_LIMIT
+        limit = min(max(limit, 1), MAX_SEARCH_LIMIT)
+        cursor = args.get("cursor")
+        if cursor is not None:
+            cursor = parse_search_cursor(cursor)
+            if cursor is None:
+                reviews_namespace.abort(400, "Invalid cursor.")
+
+        hits, next_cursor = search_reviews(
+            args["q"], args.get("place"), args.get("types"), cursor, limit
+        )
+        if next_cursor is not None:
+            next_cursor = "{}:{}".format(*next_cursor)
+        return review_hit_serializer.response(hits, 200, next_page_headers(next_cursor))
 
 
 class Reviews(Resource):
@@ -110,19 +178,9 @@ class Reviews(Resource):
 
     @reviews_namespace.response(200, "Review updated successfully!")
     @reviews_namespace.response(404, "Review <review_id> does not exist.")
-    def put(self, review_id):
+    @session_required
+    def put(self, review_id, user):
         """Updates the star rating / text of a review."""
-        # Extract token
-        was_successful, session_token = extract_token(request)
-        response_object = {}
-        if not was_successful:
-            response_object["message"] = session_token
-            return response_object, 400
-        # Check token validity
-        user = get_user_by_session_token(session_token)
-        if user is None:
-            response_object["message"] = "Invalid token."
-            return response_object, 400
         # Create / validate Review object
         user_id = user.id
         review = get_review_by_id(review_id)
@@ -135,32 +193,17 @@ class Reviews(Resource):
         rating = post_data.get("rating")
         text = post_data.get("text")
         response_object = {}
-        review = get_review_by_id(review_id)
-        if not review:
-            reviews_namespace.abort(404, f"Review {review_id} does not exist.")
         new_review = update_review(review, rating, text)
 
         response_object["message"] = f"Review {review.id} was updated!"
-        print(new_review)
         return marshal(new_review, review_fields), 200
 
     @reviews_namespace.response(200, "<review_id> was removed successfully!")
     @reviews_namespace.response(404, "Review <review_id> does not exist.")
-    def delete(self, review_id):
+    @session_required
+    def delete(self, review_id, user):
         """Deletes a review."""
-        review = get_review_by_id(review_id)
-        response_object = {}
-        # User validation before deleting
-        was_successful, session_token = extract_token(request)
         response_object = {}
-        if not was_successful:
-            response_object["message"] = session_token
-            return response_object, 400
-        # Check token validity
-        user = get_user_by_session_token(session_token)
-        if user is None:
-            response_object["message"] = "Invalid token."
-            return response_object, 400
         # Create / validate Review object
         user_id = user.id
         review = get_review_by_id(review_id)
@@ -169,13 +212,11 @@ class Reviews(Resource):
         elif user_id != review.user_id:
             reviews_namespace.abort(400, "Cannot delete other user's review")
 
-        if not review:
-            reviews_namespace.abort(404, f"Review {review_id} does not exist.")
-
         delete_review(review)
         response_object["message"] = f"Review {review.id} was deleted."
         return response_object, 200
 
 
 reviews_namespace.add_resource(ReviewsList, "")
+reviews_namespace.add_resource(ReviewsSearch, "/search")
 reviews_namespace.add_resource(Reviews, "/<int:review_id>")
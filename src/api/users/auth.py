@@ -0,0 +1,75 @@
+import datetime
+import json
+from collections import namedtuple
+from functools import wraps
+
+from flask import request
+
+from src.api.users.crud import get_user_by_session_token, session_cache
+
+# What handlers get to know about the caller, without loading a User row
+SessionUser = namedtuple(
+    "SessionUser", ["id", "email", "username", "created_date", "session_expiration"]
+)
+
+
+def extract_token(request):
+    auth_header = request.headers.get("Authorization")
+    if auth_header is None:
+        return False, json.dumps({"error": "Missing authorization header"})
+
+    bearer_token = auth_header.replace("Bearer ", "").strip()
+    if bearer_token is None or not bearer_token:
+        return False, json.dumps({"error": "invalid auth header"})
+
+    return True, bearer_token
+
+
+def get_session_user(session_token):
+    """Resolves a session token to a SessionUser, or None if the token is
+    unknown or expired. Lookups are cached per token in session_cache."""
+    now = datetime.datetime.now()
+    session_user = session_cache.get(session_token)
+    if session_user is not None:
+        if now < session_user.session_expiration:
+            return session_user
+        session_cache.delete(session_token)
+        return None
+
+    user = get_user_by_session_token(session_token)
+    if user is None or not user.verify_session_token(session_token):
+        return None
+
+    session_user = SessionUser(
+        id=user.id,
+        email=user.email,
+        username=user.username,
+        created_date=user.created_date,
+        session_expiration=user.session_expiration,
+    )
+    ttl = min(session_cache.ttl, (user.session_expiration - now).total_seconds())
+    session_cache.set(session_token, session_user, ttl=ttl)
+    return session_user
+
+
+def session_required(func):
+    """Authenticates the request's bearer session token and passes the caller
+    to the handler as `user`, or answers 400 if the token is missing, unknown
+    or expired."""
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        was_successful, session_token = extract_token(request)
+        response_object = {}
+        if not was_successful:
+            response_object["message"] = session_token
+            return response_object, 400
+
+        user = get_session_user(session_token)
+        if user is None:
+            response_object["message"] = "Unauthorized user."
+            return response_object, 400
+
+        return func(*args, user=user, **kwargs)
+
+    return wrapper
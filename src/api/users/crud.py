@@ -1,10 +1,36 @@
 from src import db
-from src.api.users.models import User
-import bcrypt
+from src.api.pagination import keyset_page, keyset_stream
+from src.api.cache import TTLCache
+from src.api.users.hashing import hash_password, needs_rehash
+from src.api.places.models import Place
+from src.api.users.models import User, assoc_favorites
+from src.replicas import replica_reads
+from sqlalchemy import Integer, all_, any_, bindparam, literal, select
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+from sqlalchemy.orm import selectinload
 
+# session token -> SessionUser, see src/api/users/auth.py
+session_cache = TTLCache(name="session")
 
+
+def _users_with_favorites():
+    # User.as_dict() reads favorites, load them for all users at once
+    return User.query.options(selectinload(User.favorites))
+
+
+@replica_reads
 def get_all_users():
-    return User.query.all()
+    return _users_with_favorites().all()
+
+
+@replica_reads
+def get_users_page(cursor=None, limit=None):
+    return keyset_page(_users_with_favorites(), User.id, cursor, limit)
+
+
+@replica_reads
+def stream_users(cursor=None, limit=None):
+    return keyset_stream(_users_with_favorites(), User.id, cursor, limit)
 
 
 def get_user_by_email(email):
@@ -35,12 +61,11 @@ def add_user(email, username, password):
 
 
 def update_user(user, email, password, username):
-    user.password_digest = bcrypt.hashpw(
-        password.encode("utf-8"), bcrypt.gensalt(rounds=13)
-    )
+    user.password_digest = hash_password(password)
     user.email = email
     user.username = username
     db.session.commit()
+    session_cache.delete(user.session_token)
     return user
 
 
@@ -49,7 +74,14 @@ def verify_credentials(email, password):
     if optional_user is None:
         return False, None
 
-    return optional_user.verify_password(password), optional_user
+    if not optional_user.verify_password(password):
+        return False, optional_user
+
+    # Upgrade digests made with a different BCRYPT_ROUNDS
+    if needs_rehash(optional_user.password_digest):
+        optional_user.password_digest = hash_password(password)
+        db.session.commit()
+    return True, optional_user
 
 
 def create_user(email, username, password):
@@ -73,16 +105,74 @@ def renew_session(update_token):
         # DAO layer -> cannot return failures
         raise Exception("Invalid update token")
 
+    old_session_token = user.session_token
     user.renew_session()
     db.session.commit()
+    session_cache.delete(old_session_token)
     return user
 
 
-def add_favorite(user, place):
-    user.favorites.append(place)
+@replica_reads
+def get_favorites(user_id, cursor=None, limit=None):
+    query = Place.query.join(
+        assoc_favorites, assoc_favorites.c.place_id == Place.id
+    ).filter(assoc_favorites.c.user_id == user_id)
+    return keyset_page(query, Place.id, cursor, limit)
+
+
+def _ids(name, place_ids):
+    # one array parameter, "= ANY(%(name)s)", whatever the number of ids;
+    # each use in a request gets its own name so that they can't collide
+    return bindparam(name, list(place_ids), type_=ARRAY(Integer))
+
+
+def _insert_favorites(user_id, place_ids):
+    # unknown place ids are skipped, existing favorites left alone
+    existing_places = select([literal(user_id), Place.id]).where(
+        Place.id == any_(_ids("add_place_ids", place_ids))
+    )
+    statement = (
+        insert(assoc_favorites)
+        .from_select(["user_id", "place_id"], existing_places)
+        .on_conflict_do_nothing()
+    )
+    return db.session.execute(statement).rowcount
+
+
+def _delete_favorites(user_id, place_ids=None, keep_place_ids=None):
+    statement = assoc_favorites.delete().where(assoc_favorites.c.user_id == user_id)
+    if place_ids is not None:
+        statement = statement.where(
+            assoc_favorites.c.place_id == any_(_ids("remove_place_ids", place_ids))
+        )
+    if keep_place_ids:
+        # "!= ALL": SQLAlchemy compiles "~(== ANY)" to "!= ANY", which is
+        # true for every id as soon as two ids are kept
+        keep = all_(_ids("keep_place_ids", keep_place_ids))
+        statement = statement.where(assoc_favorites.c.place_id != keep)
+    return db.session.execute(statement).rowcount
+
+
+def update_favorites(user_id, add=(), remove=()):
+    """Adds and removes many favorites in one transaction, returning how many
+    rows were actually added and removed."""
+    removed = _delete_favorites(user_id, place_ids=list(remove)) if remove else 0
+    added = _insert_favorites(user_id, list(add)) if add else 0
     db.session.commit()
+    return added, removed
 
 
-def remove_favorite(user, place):
-    user.favorites.remove(place)
+def replace_favorites(user_id, place_ids):
+    """Makes the user's favorites exactly `place_ids` (minus unknown ids)."""
+    removed = _delete_favorites(user_id, keep_place_ids=list(place_ids))
+    added = _insert_favorites(user_id, list(place_ids)) if place_ids else 0
     db.session.commit()
+    return added, removed
+
+
+def add_favorite(user_id, place_id):
+    return update_favorites(user_id, add=[place_id])[0]
+
+
+def remove_favorite(user_id, place_id):
+    return update_favorites(user_id, remove=[place_id])[1]
@@ -0,0 +1,110 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+from flask import current_app, has_app_context
+
+from src.metrics import bcrypt_timer
+
+
+class HashingPoolSaturated(Exception):
+    pass
+
+
+def _hashpw(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds=rounds)).decode("utf-8")
+
+
+def _checkpw(password, digest):
+    return bcrypt.checkpw(password, digest)
+
+
+def _gevent_threadpool():
+    """The gevent hub's native thread pool when running under gevent workers.
+
+    ProcessPoolExecutor's management thread does not mix well with a
+    monkey-patched threading module, and bcrypt releases the GIL, so real
+    OS threads keep it off the event loop just as well."""
+    try:
+        from gevent import get_hub, monkey
+    except ImportError:
+        return None
+    if not monkey.is_module_patched("threading"):
+        return None
+    return get_hub().threadpool
+
+
+def _config(key, default):
+    if has_app_context():
+        return current_app.config.get(key, default)
+    return default
+
+
+class HashingPool:
+    """Runs bcrypt in a small process pool, so a burst of logins cannot tie up
+    every request worker. At most BCRYPT_QUEUE_DEPTH calls may be in flight
+    (running or queued) per worker process; beyond that HashingPoolSaturated
+    is raised instead of queueing. With BCRYPT_POOL_SIZE = 0 bcrypt runs
+    inline."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._slots = None
+        self._pid = None
+
+    def _get_executor(self):
+        workers = _config("BCRYPT_POOL_SIZE", 0)
+        if workers <= 0:
+            return None, None
+        with self._lock:
+            # gunicorn forks workers after import; each needs its own pool
+            if self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=workers)
+                self._slots = threading.BoundedSemaphore(
+                    _config("BCRYPT_QUEUE_DEPTH", workers * 4)
+                )
+                self._pid = os.getpid()
+            return self._executor, self._slots
+
+    def run(self, fn, *args):
+        executor, slots = self._get_executor()
+        if executor is None:
+            return fn(*args)
+        if not slots.acquire(blocking=False):
+            raise HashingPoolSaturated()
+        try:
+            threadpool = _gevent_threadpool()
+            if threadpool is not None:
+                return threadpool.spawn(fn, *args).get()
+            return executor.submit(fn, *args).result()
+        finally:
+            slots.release()
+
+
+hashing_pool = HashingPool()
+
+
+def bcrypt_rounds():
+    return _config("BCRYPT_ROUNDS", 13)
+
+
+def hash_password(password):
+    with bcrypt_timer("hash"):
+        return hashing_pool.run(_hashpw, password.encode("utf-8"), bcrypt_rounds())
+
+
+def check_password(password, digest):
+    with bcrypt_timer("check"):
+        return hashing_pool.run(
+            _checkpw, password.encode("utf-8"), digest.encode("utf-8")
+        )
+
+
+def needs_rehash(digest):
+    # bcrypt digests look like $2b$<rounds>$<salt+hash>
+    try:
+        return int(digest.split("$")[2]) != bcrypt_rounds()
+    except (IndexError, ValueError):
+        return True
@@ -3,8 +3,8 @@ import os
 from sqlalchemy.sql import func
 
 from src import db
+from src.api.users.hashing import check_password, hash_password
 
-import bcrypt
 import hashlib
 import datetime
 
@@ -41,9 +41,7 @@ class User(db.Model):
     def __init__(self, **kwargs):
         self.email = kwargs.get("email")
         self.username = kwargs.get("username")
-        self.password_digest = bcrypt.hashpw(
-            kwargs.get("password").encode("utf-8"), bcrypt.gensalt(rounds=13)
-        ).decode("utf-8")
+        self.password_digest = hash_password(kwargs.get("password"))
         self.renew_session()
 
     # Used to randomly generate session/update tokens
@@ -57,10 +55,7 @@ class User(db.Model):
         self.update_token = self._urlsafe_base_64()
 
     def verify_password(self, password):
-        print(password.encode("utf-8"), self.password_digest.encode("utf-8"))
-        return bcrypt.checkpw(
-            password.encode("utf-8"), self.password_digest.encode("utf-8")
-        )
+        return check_password(password, self.password_digest)
 
     # Checks if session token is valid and hasn't expired
     def verify_session_token(self, session_token):
@@ -81,10 +76,3 @@ class User(db.Model):
             "update_token": self.update_token,
             "favorites": list(map(lambda x: x.id, self.favorites)),
         }
-
-
-if os.getenv("FLASK_ENV") == "development":
-    from src import admin
-    from src.api.users.admin import UsersAdminView
-
-    admin.add_view(UsersAdminView(User, db.session))
@@ -1,13 +1,20 @@
 from flask import request
 from flask_restx import Namespace, Resource, fields, marshal
-import json
+
+from src.api.pagination import (
+    add_pagination_arguments,
+    next_page_headers,
+    stream_response,
+)
 
 # from src.api.users.models import assoc_favorites
 from src.api.places.crud import get_place_by_id
+from src.api.users.auth import extract_token, session_required
+from src.api.users.hashing import HashingPoolSaturated
 from src.api.users.crud import (  # isort:skip
-    get_all_users,
+    get_users_page,
+    stream_users,
     get_user_by_email,
-    get_user_by_session_token,
     get_user_by_username,
     # get_user_by_update_token,
     verify_credentials,
@@ -16,6 +23,9 @@ from src.api.users.crud import (  # isort:skip
     # update_user,
     add_favorite,
     remove_favorite,
+    get_favorites,
+    update_favorites,
+    replace_favorites,
 )
 
 users_namespace = Namespace("users")
@@ -41,34 +51,31 @@ user_post = users_namespace.inherit(
     "User post", user, {"password": fields.String(required=True)}
 )
 
+favorites_patch = users_namespace.model(
+    "Favorites patch",
+    {"add": fields.List(fields.Integer), "remove": fields.List(fields.Integer)},
+)
+
+favorites_put = users_namespace.model(
+    "Favorites put", {"place_ids": fields.List(fields.Integer, required=True)}
+)
 
-def extract_token(request):
-    auth_header = request.headers.get("Authorization")
-    if auth_header is None:
-        return False, json.dumps({"error": "Missing authorization header"})
+MAX_FAVORITES_PER_REQUEST = 1000
 
-    bearer_token = auth_header.replace("Bearer ", "").strip()
-    if bearer_token is None or not bearer_token:
-        return False, json.dumps({"error": "invalid auth header"})
 
-    return True, bearer_token
+@users_namespace.errorhandler(HashingPoolSaturated)
+def handle_hashing_pool_saturated(error):
+    """Too many password hashes in flight, ask the client to retry."""
+    return {"message": "Server busy, please retry."}, 503, {"Retry-After": "1"}
 
 
 class Users(Resource):
     @users_namespace.expect(user)
     @users_namespace.response(400, "Unauthroized token.")
-    def get(self):
+    @session_required
+    def get(self, user):
         """Returns user based on session token."""
-        was_successful, session_token = extract_token(request)
-        response_object = {}
-        if not was_successful:
-            response_object["message"] = session_token
-            return response_object, 400
-        request_user = get_user_by_session_token(session_token)
-        if request_user is None:
-            response_object["message"] = "Unauthorized user."
-            return response_object, 400
-        return marshal(request_user, user_fields), 200
+        return marshal(user, user_fields), 200
 
     @users_namespace.expect(user_post, validate=True)
     @users_namespace.response(201, "<user_email> was added!")
@@ -102,22 +109,23 @@ class Users(Resource):
 
 
 class UsersAll(Resource):
-    @users_namespace.expect(user)
+    @users_namespace.expect(user, add_pagination_arguments())
     @users_namespace.response(400, "Unauthroized token.")
-    def get(self):
-        """Returns all users."""
-        was_successful, session_token = extract_token(request)
-        response_object = {}
-        if not was_successful:
-            response_object["message"] = session_token
-            return response_object, 400
-        request_user = get_user_by_session_token(session_token)
-        if request_user is None:
-            response_object["message"] = "Unauthorized user."
-            return response_object, 400
-        users = get_all_users()
+    @session_required
+    def get(self, user):
+        """Returns all users, or one page of them given limit/cursor."""
+        args = add_pagination_arguments().parse_args()
+        if args.get("stream"):
+            users = stream_users(args.get("cursor"), args.get("limit"))
+            return stream_response(users, lambda x: x.as_dict(), args["stream"])
+
+        users, next_cursor = get_users_page(args.get("cursor"), args.get("limit"))
         # return marshal(users, user_fields), 200
-        return list(map(lambda x: x.as_dict(), users)), 200
+        return (
+            list(map(lambda x: x.as_dict(), users)),
+            200,
+            next_page_headers(next_cursor),
+        )
 
 
 class UserRegister(Resource):
@@ -199,65 +207,86 @@ class UserLogin(Resource):
 
 class UserFavorites(Resource):
     @users_namespace.response(400, "Unauthroized token.")
-    def post(self, place_id):
+    @session_required
+    def post(self, place_id, user):
         """Adds place to user favorites."""
-        was_successful, session_token = extract_token(request)
         response_object = {}
-        if not was_successful:
-            response_object["message"] = session_token
-            return response_object, 400
-        request_user = get_user_by_session_token(session_token)
-        if request_user is None:
-            response_object["message"] = "Unauthorized user."
-            return response_object, 400
         place = get_place_by_id(place_id)
         if place is None:
             response_object["message"] = "Invalid place id."
             return response_object, 400
         # place_id and user is valid.
-        add_favorite(request_user, place)
+        add_favorite(user.id, place_id)
         response_object["message"] = "Added location as favorite!"
         return response_object, 201
 
-    def delete(self, place_id):
+    @users_namespace.response(400, "Unauthroized token.")
+    @session_required
+    def delete(self, place_id, user):
         """Removes place from user favorites."""
-        was_successful, session_token = extract_token(request)
         response_object = {}
-        if not was_successful:
-            response_object["message"] = session_token
-            return response_object, 400
-        request_user = get_user_by_session_token(session_token)
-        if request_user is None:
-            response_object["message"] = "Unauthorized user."
-            return response_object, 400
         place = get_place_by_id(place_id)
         if place is None:
             response_object["message"] = "Invalid place id."
             return response_object, 400
         # place_id and user is valid.
-        remove_favorite(request_user, place)
+        remove_favorite(user.id, place_id)
         response_object["message"] = "Removed location from favorite!"
         return response_object, 201
 
 
 class UserFavoritesList(Resource):
+    @users_namespace.expect(add_pagination_arguments())
     @users_namespace.response(400, "Unauthroized token.")
-    def post(self):
+    @session_required
+    def post(self, user):
         """Shows the list of user favorites given the session token."""
-        was_successful, session_token = extract_token(request)
+        args = add_pagination_arguments().parse_args()
+        places, next_cursor = get_favorites(
+            user.id, args.get("cursor"), args.get("limit")
+        )
+        data = []
+        for pl in places:
+            data.append(pl.serialize())
+        return data, 200, next_page_headers(next_cursor)
+
+    @users_namespace.expect(favorites_patch, validate=True)
+    @users_namespace.response(200, "Favorites updated.")
+    @users_namespace.response(400, "Unauthroized token.")
+    @session_required
+    def patch(self, user):
+        """Adds and removes many favorites at once."""
+        post_data = request.get_json()
+        add = set(post_data.get("add") or [])
+        remove = set(post_data.get("remove") or [])
         response_object = {}
-        if not was_successful:
-            response_object["message"] = session_token
+
+        if len(add) + len(remove) > MAX_FAVORITES_PER_REQUEST:
+            response_object[
+                "message"
+            ] = f"At most {MAX_FAVORITES_PER_REQUEST} place ids are allowed."
             return response_object, 400
-        request_user = get_user_by_session_token(session_token)
-        if request_user is None:
-            response_object["message"] = "Unauthorized user."
+
+        added, removed = update_favorites(user.id, add=add, remove=remove - add)
+        return {"added": added, "removed": removed}, 200
+
+    @users_namespace.expect(favorites_put, validate=True)
+    @users_namespace.response(200, "Favorites replaced.")
+    @users_namespace.response(400, "Unauthroized token.")
+    @session_required
+    def put(self, user):
+        """Replaces the user's favorites with the given place ids."""
+        place_ids = set(request.get_json().get("place_ids"))
+        response_object = {}
+
+        if len(place_ids) > MAX_FAVORITES_PER_REQUEST:
+            response_object[
+                "message"
+            ] = f"At most {MAX_FAVORITES_PER_REQUEST} place ids are allowed."
             return response_object, 400
 
-        data = []
-        for pl in request_user.favorites:
-            data.append(pl.serialize())
-        return data, 200
+        added, removed = replace_favorites(user.id, place_ids)
+        return {"added": added, "removed": removed}, 200
 
 
 users_namespace.add_resource(Users, "")
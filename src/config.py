@@ -5,6 +5,41 @@ class BaseConfig:
     TESTING = False
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SECRET_KEY = "my_precious"
+    # "postgis" or "memory" (see src/api/places/engine.py)
+    PLACES_SEARCH_ENGINE = os.getenv("PLACES_SEARCH_ENGINE", "postgis")
+    PLACES_ENGINE_MAX_AGE = int(os.getenv("PLACES_ENGINE_MAX_AGE", "300"))
+    SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "10000"))
+    SESSION_CACHE_TTL = int(os.getenv("SESSION_CACHE_TTL", "60"))
+    # nearby-search cache (src/api/places/search_cache.py): cells kept per
+    # worker, 0 disables it; SEARCH_CACHE_URL=redis://... shares one cache
+    # between workers instead (needs the redis package)
+    SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "4096"))
+    SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "30"))
+    SEARCH_CACHE_URL = os.getenv("SEARCH_CACHE_URL")
+    SEARCH_CACHE_PRECISION = 7  # geohash characters, ~150m cells
+    SEARCH_CACHE_MAX_RADIUS = 1600  # meters, wider searches skip the cache
+    SEARCH_CACHE_MAX_CANDIDATES = 1000
+    BCRYPT_ROUNDS = 13
+    # bcrypt worker processes per request worker, 0 runs bcrypt inline
+    BCRYPT_POOL_SIZE = int(os.getenv("BCRYPT_POOL_SIZE", "2"))
+    BCRYPT_QUEUE_DEPTH = int(os.getenv("BCRYPT_QUEUE_DEPTH", "8"))
+    # statements repeated this often in one request are logged as N+1
+    QUERY_REPEAT_THRESHOLD = 5
+    QUERY_REPEAT_RAISE = False
+    # slow-query log (src/slow_queries.py), 0 disables it
+    SLOW_QUERY_MS = int(os.getenv("SLOW_QUERY_MS", "200"))
+    SLOW_QUERY_LOG = os.getenv("SLOW_QUERY_LOG", "/tmp/slow_queries.log")
+    SLOW_QUERY_LOG_BYTES = 10 * 1024 * 1024
+    SLOW_QUERY_LOG_BACKUPS = 5
+    # fraction of slow SELECTs whose EXPLAIN (ANALYZE, BUFFERS) is captured
+    SLOW_QUERY_EXPLAIN_SAMPLE = float(os.getenv("SLOW_QUERY_EXPLAIN_SAMPLE", "0"))
+    SLOW_QUERY_EXPLAIN_TIMEOUT_MS = 10000
+    # read replicas (src/replicas.py), comma separated urls
+    DATABASE_REPLICA_URLS = os.getenv("DATABASE_REPLICA_URLS")
+    REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", "5"))
+    REPLICA_LAG_CHECK_INTERVAL = 5
+    # seconds a client reads from the primary after one of its writes
+    REPLICA_READ_YOUR_WRITES = 10
 
 
 class DevelopmentConfig(BaseConfig):
@@ -13,9 +48,25 @@ class DevelopmentConfig(BaseConfig):
 
 class TestingConfig(BaseConfig):
     TESTING = True
+    BCRYPT_ROUNDS = 4
+    BCRYPT_POOL_SIZE = 0
+    SEARCH_CACHE_SIZE = 0
+    QUERY_REPEAT_RAISE = True
+    SLOW_QUERY_MS = 0
     SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_TEST_URL")
+    DATABASE_REPLICA_URLS = os.environ.get("DATABASE_TEST_REPLICA_URLS")
 
 
 class ProductionConfig(BaseConfig):
     SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_URL")
     SECRET_KEY = os.getenv("SECRET_KEY", "my_precious")
+    # Per worker process. Under gevent workers every in-flight request is a
+    # greenlet with its own scoped session, so the pool (not the worker
+    # count) bounds concurrent queries; keep
+    # workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) below max_connections.
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "10")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+        "pool_timeout": int(os.getenv("DB_POOL_TIMEOUT", "10")),
+        "pool_pre_ping": True,
+    }
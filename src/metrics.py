@@ -0,0 +1,137 @@
+"""Prometheus metrics, served in the text format at GET /metrics.
+
+Records per flask-restx resource (the request's endpoint) and method the
+request count and latency, and the time and number of SQL statements (from
+query_stats). Also records database pool checkout waits, bcrypt time and
+cache lookups by cache and result.
+
+Under gunicorn every worker process keeps its own counters. With
+PROMETHEUS_MULTIPROC_DIR set (gunicorn.conf.py does) they write them to
+files in that directory instead, and /metrics adds up every worker's
+files, whichever worker serves the scrape. The variable must be set before
+prometheus_client is imported, and the directory emptied on startup.
+"""
+import os
+import time
+
+from flask import Response, g, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy.pool import QueuePool
+
+METRICS_PATH = "/metrics"
+
+REQUESTS = Counter(
+    "http_requests_total",
+    "Requests handled, by resource, method and status.",
+    ["resource", "method", "status"],
+)
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Time to build each response, by resource and method. Streamed bodies "
+    "are not included.",
+    ["resource", "method"],
+)
+DB_SECONDS = Histogram(
+    "http_request_db_seconds",
+    "Time spent in SQL statements per request, by resource and method.",
+    ["resource", "method"],
+)
+DB_QUERIES = Counter(
+    "http_request_db_queries_total",
+    "SQL statements run while handling requests, by resource and method.",
+    ["resource", "method"],
+)
+POOL_WAIT_SECONDS = Histogram(
+    "db_pool_checkout_seconds",
+    "Time to check out a database connection, including waiting for a free "
+    "one and opening new ones.",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10),
+)
+BCRYPT_SECONDS = Histogram(
+    "bcrypt_seconds",
+    "Time to hash or check a password, including the hashing pool's queue.",
+    ["operation"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+CACHE_LOOKUPS = Counter(
+    "cache_lookups_total",
+    "Cache lookups by cache and result (hit, miss or bypass).",
+    ["cache", "result"],
+)
+
+
+def cache_lookup(cache, result):
+    """Counts a lookup in `cache`; result is "hit", "miss" or "bypass"."""
+    CACHE_LOOKUPS.labels(cache, result).inc()
+
+
+def bcrypt_timer(operation):
+    return BCRYPT_SECONDS.labels(operation).time()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool recording how long each checkout took."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_WAIT_SECONDS.observe(time.perf_counter() - started)
+
+
+def _labels():
+    return request.endpoint or "unmatched", request.method
+
+
+def _start_request():
+    g.metrics_started_at = time.perf_counter()
+
+
+def _finish_request(response):
+    started_at = g.get("metrics_started_at")
+    if started_at is None or request.path == METRICS_PATH:
+        return response
+
+    resource, method = _labels()
+    REQUESTS.labels(resource, method, str(response.status_code)).inc()
+    REQUEST_SECONDS.labels(resource, method).observe(time.perf_counter() - started_at)
+    stats = g.get("query_stats")
+    if stats is not None:
+        DB_SECONDS.labels(resource, method).observe(stats.duration)
+        DB_QUERIES.labels(resource, method).inc(stats.count)
+    return response
+
+
+def _registry():
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def _metrics():
+    return Response(generate_latest(_registry()), mimetype=CONTENT_TYPE_LATEST)
+
+
+def init_app(app):
+    """Registers the request hooks and /metrics. Call before db.init_app,
+    so that Postgres engines get a TimedQueuePool."""
+    uri = app.config.get("SQLALCHEMY_DATABASE_URI") or ""
+    if uri.startswith("postgresql"):
+        options = dict(app.config.get("SQLALCHEMY_ENGINE_OPTIONS") or {})
+        options.setdefault("poolclass", TimedQueuePool)
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.add_url_rule(METRICS_PATH, "metrics", _metrics)
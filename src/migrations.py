@@ -0,0 +1,100 @@
+"""Idempotent schema changes for databases created before the current models.
+
+`db.create_all()` only creates missing tables, so columns and indexes added to
+existing tables are applied here, in order, by `python manage.py migrate_db`.
+Each step is safe to re-run. Steps building an index CONCURRENTLY run outside
+a transaction, as Postgres requires, and don't block writes to the table.
+"""
+
+from sqlalchemy import text
+
+from src import db
+
+MIGRATIONS = [
+    (
+        "backfill places.coords from lat/lon",
+        """
+        UPDATE places
+        SET coords = ST_SetSRID(ST_MakePoint(lon, lat), 4326)::geography
+        WHERE ST_X(coords::geometry) <> lon OR ST_Y(coords::geometry) <> lat
+        """,
+    ),
+    (
+        "gist index on places.coords",
+        "CREATE INDEX IF NOT EXISTS idx_places_coords ON places USING GIST (coords)",
+    ),
+    (
+        "btree index on places.types",
+        "CREATE INDEX IF NOT EXISTS ix_places_types ON places (types)",
+    ),
+    (
+        "places.rating_sum",
+        "ALTER TABLE places ADD COLUMN IF NOT EXISTS rating_sum integer NOT NULL DEFAULT 0",
+    ),
+    (
+        "places.rating_count",
+        "ALTER TABLE places ADD COLUMN IF NOT EXISTS rating_count integer NOT NULL DEFAULT 0",
+    ),
+    (
+        "places.rating_updated_at",
+        "ALTER TABLE places ADD COLUMN IF NOT EXISTS "
+        "rating_updated_at timestamp with time zone",
+    ),
+    (
+        "btree index on places.rating_updated_at",
+        "CREATE INDEX IF NOT EXISTS ix_places_rating_updated_at "
+        "ON places (rating_updated_at)",
+    ),
+    (
+        "btree index on reviews.place_id",
+        "CREATE INDEX IF NOT EXISTS ix_reviews_place_id ON reviews (place_id)",
+    ),
+    (
+        "catalog_version table",
+        """
+        CREATE TABLE IF NOT EXISTS catalog_version (
+            id integer PRIMARY KEY,
+            version bigint NOT NULL,
+            updated_at timestamp with time zone NOT NULL
+        )
+        """,
+    ),
+    (
+        "place_tiles table",
+        """
+        CREATE TABLE IF NOT EXISTS place_tiles (
+            z integer NOT NULL,
+            x integer NOT NULL,
+            y integer NOT NULL,
+            payload text NOT NULL,
+            created_at timestamp with time zone NOT NULL DEFAULT now(),
+            PRIMARY KEY (z, x, y)
+        )
+        """,
+    ),
+    (
+        "reviews.text_tsv",
+        "ALTER TABLE reviews ADD COLUMN IF NOT EXISTS text_tsv tsvector",
+    ),
+    (
+        # If a concurrent build fails it leaves an INVALID index behind,
+        # which IF NOT EXISTS would skip: drop it and run migrate_db again.
+        "gin index on reviews.text_tsv",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_reviews_text_tsv "
+        "ON reviews USING GIN (text_tsv)",
+    ),
+    ("analyze places", "ANALYZE places"),
+]
+
+
+def run_migrations(echo=print):
+    for name, statement in MIGRATIONS:
+        echo(f"-> {name}")
+        if "CONCURRENTLY" in statement:
+            with db.engine.connect() as connection:
+                connection.execution_options(isolation_level="AUTOCOMMIT").execute(
+                    text(statement)
+                )
+            continue
+        db.session.execute(text(statement))
+        db.session.commit()
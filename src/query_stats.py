@@ -0,0 +1,95 @@
+"""Per-request SQL statistics.
+
+Every statement run while handling a request is counted and timed through
+SQLAlchemy cursor events. The totals are sent back in a Server-Timing header,
+and statements repeated QUERY_REPEAT_THRESHOLD or more times in one request
+(the N+1 pattern) are logged, or raise NPlusOneDetected when
+QUERY_REPEAT_RAISE is set.
+"""
+import logging
+import time
+from collections import Counter
+
+from flask import current_app, g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+
+class NPlusOneDetected(Exception):
+    pass
+
+
+class QueryStats:
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.count = 0
+        self.duration = 0.0
+        self.statements = Counter()
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        self.statements[statement] += 1
+
+    def repeated(self, threshold):
+        return [
+            (statement, count)
+            for statement, count in self.statements.items()
+            if count >= threshold
+        ]
+
+
+def current_stats():
+    if not has_request_context():
+        return None
+    if "query_stats" not in g:
+        g.query_stats = QueryStats()
+    return g.query_stats
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.query_started_at = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started_at = getattr(context, "query_started_at", None)
+    stats = current_stats()
+    if stats is not None and started_at is not None:
+        stats.record(statement, time.perf_counter() - started_at)
+
+
+def _start_request():
+    current_stats()
+
+
+def _finish_request(response):
+    stats = g.get("query_stats")
+    if stats is None:
+        return response
+
+    total = (time.perf_counter() - stats.started_at) * 1000
+    response.headers.add(
+        "Server-Timing",
+        f'db;dur={stats.duration * 1000:.2f};desc="{stats.count} queries"',
+    )
+    response.headers.add("Server-Timing", f"app;dur={total:.2f}")
+
+    repeated = stats.repeated(current_app.config["QUERY_REPEAT_THRESHOLD"])
+    for statement, count in repeated:
+        logger.warning("Possible N+1: statement ran %d times: %s", count, statement)
+    if repeated and current_app.config["QUERY_REPEAT_RAISE"]:
+        raise NPlusOneDetected(
+            f"{len(repeated)} statement(s) repeated in one request: {repeated}"
+        )
+    return response
+
+
+def init_app(app):
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
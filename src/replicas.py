@@ -0,0 +1,250 @@
+"""Read replica routing, enabled by DATABASE_REPLICA_URLS.
+
+Each replica url becomes a `replica_<n>` entry of SQLALCHEMY_BINDS, so it
+gets its own engine and connection pool. Crud functions decorated with
+`replica_reads` run their queries on one replica per session (request);
+everything else uses the primary, as do functions decorated with
+`primary_reads` wherever they are called from. A session switches back to
+the primary for good once it has written (see `writes`), and so does a
+request carrying the read-your-writes cookie or header set after a write,
+or when the replica lags more than REPLICA_MAX_LAG seconds.
+
+Point DATABASE_REPLICA_URLS at a streaming standby, or, for tests, at a
+second url of the primary database itself.
+"""
+import random
+import re
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, g, request
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import orm, text
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.elements import TextClause
+
+REPLICA_BIND_PREFIX = "replica_"
+READ_PRIMARY_COOKIE = "read_primary"
+READ_PRIMARY_HEADER = "X-Read-Primary"
+
+# text() statements are reads only when they start with one of these and
+# take no row locks. Anything else, WITH queries included, may write.
+READ_STATEMENT = re.compile(r"\s*(SELECT|VALUES|SHOW)\b", re.IGNORECASE)
+ROW_LOCK = re.compile(r"\bFOR\s+(NO\s+KEY\s+)?(UPDATE|SHARE)\b", re.IGNORECASE)
+
+LAG_SQL = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+END
+"""
+
+
+def writes(clause):
+    """Whether a statement may write: insert, update and delete constructs,
+    and text() that isn't a plain read."""
+    if isinstance(clause, UpdateBase):
+        return True
+    if isinstance(clause, TextClause):
+        return not READ_STATEMENT.match(clause.text) or bool(
+            ROW_LOCK.search(clause.text)
+        )
+    return False
+
+
+def replica_bind_names(app):
+    binds = app.config.get("SQLALCHEMY_BINDS") or {}
+    return sorted(name for name in binds if name.startswith(REPLICA_BIND_PREFIX))
+
+
+class ReplicaLag:
+    """Per-process cache of each replica's lag in seconds, refreshed at most
+    every REPLICA_LAG_CHECK_INTERVAL seconds. None means the replica could
+    not be reached or its lag is unknown."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._checked = {}
+
+    def measure(self, engine):
+        try:
+            with engine.connect() as connection:
+                lag = connection.execute(text(LAG_SQL)).scalar()
+        except Exception as e:
+            current_app.logger.warning("Replica lag check failed: %s", e)
+            return None
+        return None if lag is None else float(lag)
+
+    def get(self, bind, engine, interval):
+        now = time.monotonic()
+        with self._lock:
+            checked = self._checked.get(bind)
+            if checked is not None and now - checked[0] < interval:
+                return checked[1]
+        lag = self.measure(engine)
+        with self._lock:
+            self._checked[bind] = (now, lag)
+        return lag
+
+    def clear(self):
+        with self._lock:
+            self._checked.clear()
+
+
+replica_lag = ReplicaLag()
+
+
+class RoutingSession(SignallingSession):
+    def __init__(self, db, **options):
+        super().__init__(db, **options)
+        self.db = db
+        self.replica_depth = 0
+        self.wrote = False
+        self._replica_bind = None
+
+    def _pick_replica(self):
+        # one replica per session, False when there are none
+        if self._replica_bind is None:
+            names = replica_bind_names(self.app)
+            self._replica_bind = random.choice(names) if names else False
+        return self._replica_bind
+
+    def _replica_engine(self):
+        if self.replica_depth <= 0 or self.wrote or g.get("read_primary"):
+            return None
+        bind = self._pick_replica()
+        if not bind:
+            return None
+        engine = self.db.get_engine(self.app, bind=bind)
+        config = self.app.config
+        lag = replica_lag.get(bind, engine, config["REPLICA_LAG_CHECK_INTERVAL"])
+        if lag is None or lag > config["REPLICA_MAX_LAG"]:
+            return None
+        return engine
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or writes(clause):
+            self.wrote = True
+        else:
+            engine = self._replica_engine()
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def _session():
+    return current_app.extensions["sqlalchemy"].db.session()
+
+
+class _ReplicaScope:
+    def __init__(self, session):
+        self.session = session
+
+    def __enter__(self):
+        self.session.replica_depth += 1
+
+    def __exit__(self, *exc):
+        self.session.replica_depth -= 1
+
+
+class _PrimaryScope:
+    def __init__(self, session):
+        self.session = session
+
+    def __enter__(self):
+        self.depth, self.session.replica_depth = self.session.replica_depth, 0
+
+    def __exit__(self, *exc):
+        self.session.replica_depth = self.depth
+
+
+def _iterate_on_replica(session, rows):
+    with _ReplicaScope(session):
+        yield from rows
+
+
+def replica_reads(func):
+    """Runs a read-only crud function's queries on a replica when routing
+    allows it. A returned Query (the streaming crud functions) is run on
+    the replica as it is iterated."""
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        session = _session()
+        with _ReplicaScope(session):
+            result = func(*args, **kwargs)
+        if isinstance(result, orm.Query):
+            return _iterate_on_replica(session, result)
+        return result
+
+    return wrapper
+
+
+def primary_reads(func):
+    """Runs a crud function's queries on the primary, even when it is called
+    from a replica_reads one. For loaders of caches that outlive replica lag
+    and are invalidated after the primary commits."""
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with _PrimaryScope(_session()):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def reads_primary():
+    """Whether this request's reads go to the primary whatever their
+    decorator, to see its own or its client's recent writes. Caches that
+    can be staler than the primary must be skipped then too."""
+    return bool(g.get("read_primary")) or _session().wrote
+
+
+def _before_request():
+    g.read_primary = bool(
+        request.cookies.get(READ_PRIMARY_COOKIE)
+        or request.headers.get(READ_PRIMARY_HEADER)
+    )
+
+
+def _after_request(response):
+    db = current_app.extensions["sqlalchemy"].db
+    if db.session.registry.has() and db.session().wrote:
+        response.set_cookie(
+            READ_PRIMARY_COOKIE,
+            "1",
+            max_age=current_app.config["REPLICA_READ_YOUR_WRITES"],
+            httponly=True,
+        )
+    return response
+
+
+def init_app(app):
+    """Turns DATABASE_REPLICA_URLS into binds. Call before db.init_app."""
+    urls = app.config.get("DATABASE_REPLICA_URLS") or ""
+    if isinstance(urls, str):
+        urls = [url.strip() for url in urls.split(",") if url.strip()]
+    if not urls:
+        return
+
+    binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+    for n, url in enumerate(urls):
+        binds[f"{REPLICA_BIND_PREFIX}{n}"] = url
+    app.config["SQLALCHEMY_BINDS"] = binds
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+
+
+def replica_status(app, db):
+    """{bind name: lag in seconds or None} of every replica, measured now."""
+    return {
+        bind: replica_lag.measure(db.get_engine(app, bind=bind))
+        for bind in replica_bind_names(app)
+    }
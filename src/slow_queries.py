@@ -0,0 +1,267 @@
+"""Slow-query log, summarized by `manage.py slow_queries`.
+
+Statements taking SLOW_QUERY_MS or longer are written as JSON lines to the
+rotating file SLOW_QUERY_LOG. Each line has the statement, the shapes (not
+the values) of its parameters, the src function that ran it (the crud
+function when there is one) and the route. A SLOW_QUERY_EXPLAIN_SAMPLE
+fraction of slow SELECTs also gets its EXPLAIN (ANALYZE, BUFFERS) plan.
+
+EXPLAIN ANALYZE runs the statement again, on another pooled connection
+outside the caller's transaction, under SLOW_QUERY_EXPLAIN_TIMEOUT_MS.
+
+Every process rotates the file on its own, so with several gunicorn
+workers the files can grow a little past SLOW_QUERY_LOG_BYTES. Logging
+never fails the statement: if an entry can't be written (say the file is
+not writable), the log is turned off in that process after one warning.
+"""
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import current_app, has_app_context, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+MAX_STATEMENT_LENGTH = 4000
+# frames of these modules are skipped when looking for the calling function
+WRAPPER_MODULES = {__name__, "src.replicas", "src.query_stats", "src.metrics"}
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_loggers = {}
+_disabled = False
+
+
+class _FileHandler(logging.handlers.RotatingFileHandler):
+    def handleError(self, record):
+        # re-raise write and rotation errors, instead of printing them on
+        # every entry, so that _after_cursor_execute turns the log off
+        raise
+
+
+def _logger(path, max_bytes, backups):
+    """A per-process logger writing bare lines to the rotating file `path`."""
+    with _lock:
+        file_logger = _loggers.get(path)
+        if file_logger is None:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            handler = _FileHandler(
+                path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8"
+            )
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            file_logger = logging.getLogger(f"{__name__}.{len(_loggers)}")
+            file_logger.setLevel(logging.INFO)
+            file_logger.propagate = False
+            file_logger.addHandler(handler)
+            _loggers[path] = file_logger
+        return file_logger
+
+
+def fingerprint(statement):
+    """The statement with parameters as ? and repeated lists of them (IN
+    lists, VALUES rows) collapsed, so that its variants group together."""
+    statement = re.sub(r"%\(\w+\)s|%s", "?", statement)
+    statement = re.sub(r"\s+", " ", statement).strip()
+    statement = re.sub(r"\?(?:, \?)+", "?, ...", statement)
+    return re.sub(r"(\([^()]*(?:\([^()]*\)[^()]*)*\))(?:, \1)+", r"\1, ...", statement)
+
+
+def _shape(value):
+    if isinstance(value, (list, tuple)):
+        return f"{type(value).__name__}[{len(value)}]"
+    return type(value).__name__
+
+
+def parameter_shapes(parameters, executemany=False):
+    """Type names (and lengths of sequences) of a statement's parameters."""
+    if executemany:
+        rows = list(parameters)
+        first = parameter_shapes(rows[0]) if rows else None
+        return {"rows": len(rows), "row": first}
+    if isinstance(parameters, dict):
+        return {key: _shape(value) for key, value in sorted(parameters.items())}
+    if isinstance(parameters, (list, tuple)):
+        return [_shape(value) for value in parameters]
+    return None
+
+
+def _caller():
+    """module.function of the innermost src function on the stack, preferring
+    crud functions."""
+    frame = sys._getframe(1)
+    first = None
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "")
+        if module.startswith("src.") and module not in WRAPPER_MODULES:
+            name = f"{module}.{frame.f_code.co_name}"
+            if module.endswith(".crud"):
+                return name
+            first = first or name
+        frame = frame.f_back
+    return first
+
+
+def _route():
+    if not has_request_context():
+        return None
+    return {
+        "method": request.method,
+        "endpoint": request.endpoint,
+        "path": request.path,
+    }
+
+
+def explain(engine, statement, parameters, timeout_ms):
+    """EXPLAIN (ANALYZE, BUFFERS) plan of a SELECT, run on a connection of
+    its own and rolled back."""
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(f"SET LOCAL statement_timeout = {int(timeout_ms)}")
+        cursor.execute(
+            "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + statement, parameters
+        )
+        plan = cursor.fetchone()[0]
+        cursor.close()
+        return plan
+    finally:
+        connection.rollback()
+        connection.close()
+
+
+def _explainable(conn, statement, executemany):
+    return (
+        not executemany
+        and conn.dialect.name == "postgresql"
+        and statement.lstrip().upper().startswith("SELECT")
+    )
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.slow_query_started_at = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    global _disabled
+    started_at = getattr(context, "slow_query_started_at", None)
+    if started_at is None or _disabled or not has_app_context():
+        return
+    duration_ms = (time.perf_counter() - started_at) * 1000
+    config = current_app.config
+    threshold = config.get("SLOW_QUERY_MS")
+    if not threshold or duration_ms < threshold:
+        return
+
+    try:
+        _log_slow_query(conn, statement, parameters, executemany, duration_ms, config)
+    except Exception as e:
+        _disabled = True
+        logger.warning(
+            "Slow-query log disabled in this process, writing %s failed: %s",
+            config.get("SLOW_QUERY_LOG"),
+            e,
+        )
+
+
+def _log_slow_query(conn, statement, parameters, executemany, duration_ms, config):
+    entry = {
+        "at": datetime.datetime.utcnow().isoformat(timespec="milliseconds"),
+        "duration_ms": round(duration_ms, 3),
+        "fingerprint": fingerprint(statement),
+        "statement": statement[:MAX_STATEMENT_LENGTH],
+        "parameters": parameter_shapes(parameters, executemany),
+        "caller": _caller(),
+        "route": _route(),
+        "database": conn.engine.url.database,
+    }
+    sample = config.get("SLOW_QUERY_EXPLAIN_SAMPLE") or 0
+    if (
+        sample > 0
+        and random.random() < sample
+        and _explainable(conn, statement, executemany)
+    ):
+        try:
+            entry["plan"] = explain(
+                conn.engine,
+                statement,
+                parameters,
+                config["SLOW_QUERY_EXPLAIN_TIMEOUT_MS"],
+            )
+        except Exception as e:
+            entry["plan_error"] = str(e)
+
+    _logger(
+        config["SLOW_QUERY_LOG"],
+        config["SLOW_QUERY_LOG_BYTES"],
+        config["SLOW_QUERY_LOG_BACKUPS"],
+    ).info(json.dumps(entry, default=str))
+
+
+def init_app(app):
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def read_log(path, backups):
+    """Entries of the slow-query log and its rotated files, oldest first."""
+    paths = [f"{path}.{n}" for n in range(backups, 0, -1)] + [path]
+    for name in paths:
+        if not os.path.exists(name):
+            continue
+        with open(name, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+def slow_query_report(entries, limit=20):
+    """The `limit` statement fingerprints with the most total time, with
+    their count, total, mean and max duration, most common callers and
+    routes, and the plan of the slowest sampled run."""
+    groups = {}
+    for entry in entries:
+        group = groups.setdefault(
+            entry["fingerprint"],
+            {
+                "fingerprint": entry["fingerprint"],
+                "count": 0,
+                "total_ms": 0.0,
+                "max_ms": 0.0,
+                "callers": Counter(),
+                "routes": Counter(),
+                "plan": None,
+                "plan_ms": 0.0,
+            },
+        )
+        duration = entry["duration_ms"]
+        group["count"] += 1
+        group["total_ms"] += duration
+        group["max_ms"] = max(group["max_ms"], duration)
+        group["callers"][entry.get("caller")] += 1
+        route = entry.get("route")
+        if route:
+            group["routes"][f"{route['method']} {route['endpoint']}"] += 1
+        if entry.get("plan") is not None and duration >= group["plan_ms"]:
+            group["plan"], group["plan_ms"] = entry["plan"], duration
+
+    worst = sorted(groups.values(), key=lambda group: -group["total_ms"])[:limit]
+    for group in worst:
+        group["mean_ms"] = group["total_ms"] / group["count"]
+        group["callers"] = group["callers"].most_common(3)
+        group["routes"] = group["routes"].most_common(3)
+    return worst
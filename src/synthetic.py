@@ -0,0 +1,203 @@
+"""Synthetic campus data for load testing, see `manage.py generate_synthetic`.
+
+Places are scattered around cluster centers (buildings) inside the campus
+bounding box, review volume per place is skewed so a few places get most of
+the reviews, and everything is bulk loaded with COPY in chunks.
+"""
+import csv
+import datetime
+import io
+import uuid
+
+import numpy as np
+from sqlalchemy import text
+
+from src import db
+from src.api.places.crud import backfill_ratings, bump_catalog_version
+from src.api.places.models import DEFAULT_IMG
+from src.api.places.tiles import clear_tiles
+from src.api.reviews.models import TSVECTOR_SQL
+from src.api.users.hashing import hash_password
+
+CAMPUS_BOUNDS = (42.4400, -76.4950, 42.4600, -76.4650)  # south, west, north, east
+PLACE_TYPES = ("Blue Light", "Bathroom", "Water")
+PLACE_TYPE_WEIGHTS = (0.2, 0.5, 0.3)
+CLUSTER_SPREAD_DEG = 0.0008  # ~80m
+RATING_WEIGHTS = (0.03, 0.05, 0.1, 0.22, 0.3, 0.3)  # ratings 0..5
+WORDS = (
+    "broken cold water clean dirty quiet busy bright dark great fine slow "
+    "fast warm accessible crowded empty convenient far close smells fresh"
+).split()
+CHUNK_SIZE = 100000
+
+
+def _copy(table, columns, rows):
+    """COPYs an iterable of row tuples into `table`, CHUNK_SIZE rows at a time."""
+    cursor = db.session.connection().connection.cursor()
+    statement = f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+    try:
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        pending = 0
+        for row in rows:
+            writer.writerow(row)
+            pending += 1
+            if pending == CHUNK_SIZE:
+                buf.seek(0)
+                cursor.copy_expert(statement, buf)
+                buf = io.StringIO()
+                writer = csv.writer(buf)
+                pending = 0
+        if pending:
+            buf.seek(0)
+            cursor.copy_expert(statement, buf)
+    finally:
+        cursor.close()
+
+
+def _new_ids(table, after_id):
+    rows = db.session.execute(
+        text(f"SELECT id FROM {table} WHERE id > :after_id ORDER BY id"),
+        {"after_id": after_id},
+    )
+    return np.array([row[0] for row in rows], dtype=np.int64)
+
+
+def _max_id(table):
+    statement = text(f"SELECT COALESCE(MAX(id), 0) FROM {table}")
+    return db.session.execute(statement).scalar()
+
+
+def generate_places(rng, count, clusters):
+    south, west, north, east = CAMPUS_BOUNDS
+    centers = np.column_stack(
+        [rng.uniform(south, north, clusters), rng.uniform(west, east, clusters)]
+    )
+    owner = rng.integers(0, clusters, count)
+    lats = centers[owner, 0] + rng.normal(0, CLUSTER_SPREAD_DEG, count)
+    lons = centers[owner, 1] + rng.normal(0, CLUSTER_SPREAD_DEG, count)
+    types = rng.choice(len(PLACE_TYPES), count, p=PLACE_TYPE_WEIGHTS)
+
+    for i in range(count):
+        lat, lon = round(float(lats[i]), 7), round(float(lons[i]), 7)
+        yield (
+            f"Synthetic {PLACE_TYPES[types[i]]} {i}",
+            lat,
+            lon,
+            f"SRID=4326;POINT({lon} {lat})",
+            PLACE_TYPES[types[i]],
+            DEFAULT_IMG,
+            0,
+            0,
+        )
+
+
+def generate_users(count, now):
+    # One shared digest, hashing millions of passwords would dominate the run
+    digest = hash_password("password")
+    expiration = now + datetime.timedelta(days=1)
+    prefix = uuid.uuid4().hex[:8]
+    for i in range(count):
+        yield (
+            f"synthetic-{prefix}-{i}@example.edu",
+            f"synthetic-{prefix}-{i}",
+            digest,
+            now,
+            uuid.uuid4().hex,
+            expiration,
+            uuid.uuid4().hex,
+        )
+
+
+def _skewed_choice(rng, ids, count):
+    # Squaring a uniform sample favours low indices: a few popular places
+    # get most of the reviews and favorites
+    idx = np.floor(len(ids) * rng.random(count) ** 2).astype(np.int64)
+    return ids[idx]
+
+
+def generate_reviews(rng, user_ids, place_ids, count, now):
+    for start in range(0, count, CHUNK_SIZE):
+        n = min(CHUNK_SIZE, count - start)
+        users = rng.choice(user_ids, n)
+        places = _skewed_choice(rng, place_ids, n)
+        ratings = rng.choice(len(RATING_WEIGHTS), n, p=RATING_WEIGHTS)
+        lengths = rng.integers(3, 12, n)
+        for i in range(n):
+            words = rng.choice(WORDS, lengths[i])
+            yield (
+                int(users[i]),
+                int(places[i]),
+                now,
+                int(ratings[i]),
+                " ".join(words).capitalize() + ".",
+            )
+
+
+def generate_favorites(rng, user_ids, place_ids, count):
+    users = rng.choice(user_ids, count)
+    places = _skewed_choice(rng, place_ids, count)
+    pairs = np.unique(np.column_stack([users, places]), axis=0)
+    for user_id, place_id in pairs:
+        yield int(user_id), int(place_id)
+
+
+def generate_synthetic(
+    places=100000, users=10000, reviews=1000000, favorites=100000, clusters=60, seed=0
+):
+    """Adds synthetic rows on top of what is in the database, in one
+    transaction, and returns how many rows of each kind were written."""
+    rng = np.random.default_rng(seed)
+    now = datetime.datetime.now()
+
+    first_place = _max_id("places")
+    _copy(
+        "places",
+        ("name", "lat", "lon", "coords", "types", "image_url")
+        + ("rating_sum", "rating_count"),
+        generate_places(rng, places, clusters),
+    )
+    place_ids = _new_ids("places", first_place)
+
+    first_user = _max_id("users")
+    _copy(
+        "users",
+        ("email", "username", "password_digest", "created_date")
+        + ("session_token", "session_expiration", "update_token"),
+        generate_users(users, now),
+    )
+    user_ids = _new_ids("users", first_user)
+
+    written = {"places": len(place_ids), "users": len(user_ids)}
+    if len(place_ids) and len(user_ids):
+        first_review = _max_id("reviews")
+        _copy(
+            "reviews",
+            ("user_id", "place_id", "created_date", "rating", "text"),
+            generate_reviews(rng, user_ids, place_ids, reviews, now),
+        )
+        # COPY can't compute the search vector; nothing else sees these
+        # rows before the commit, so one UPDATE is fine
+        db.session.execute(
+            text(
+                f"UPDATE reviews SET text_tsv = {TSVECTOR_SQL.format(text='text')} "
+                "WHERE id > :after_id"
+            ),
+            {"after_id": first_review},
+        )
+        _copy(
+            "assoc_favorites",
+            ("user_id", "place_id"),
+            generate_favorites(rng, user_ids, place_ids, favorites),
+        )
+        written["reviews"] = reviews
+        written["favorites"] = db.session.execute(
+            text("SELECT count(*) FROM assoc_favorites WHERE user_id > :after_id"),
+            {"after_id": first_user},
+        ).scalar()
+
+    bump_catalog_version()
+    clear_tiles()
+    # commits, and brings places.rating_sum/rating_count up to date
+    backfill_ratings()
+    return written
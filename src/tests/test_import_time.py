@@ -0,0 +1,26 @@
+"""Cold-start budget of production workers, see benchmarks/import_time.py.
+
+The budget is IMPORT_TIME_BUDGET_MS, 1200 by default.
+"""
+import os
+import statistics
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import import_time  # noqa: E402
+
+BUDGET_MS = float(os.getenv("IMPORT_TIME_BUDGET_MS", "1200"))
+RUNS = 3
+
+
+def test_wsgi_import_is_within_budget():
+    env = import_time.production_env()
+    timings = [import_time.run_once(env)[0]["ms"] for _ in range(RUNS)]
+    assert statistics.median(timings) <= BUDGET_MS
+
+
+def test_wsgi_import_loads_no_forbidden_modules():
+    result, _ = import_time.run_once(import_time.production_env())
+    assert import_time.forbidden_modules(result["modules"]) == []
@@ -0,0 +1,114 @@
+"""Replica routing against a real primary and replica.
+
+Runs when DATABASE_TEST_URL and DATABASE_TEST_REPLICA_URLS are set, e.g.
+to a streaming standby of the test database, or to a second url of the
+test database itself:
+
+    DATABASE_TEST_REPLICA_URLS=$DATABASE_TEST_URL python -m pytest src/tests
+"""
+import os
+
+import pytest
+from sqlalchemy import text
+
+pytestmark = pytest.mark.skipif(
+    not (os.getenv("DATABASE_TEST_URL") and os.getenv("DATABASE_TEST_REPLICA_URLS")),
+    reason="needs DATABASE_TEST_URL and DATABASE_TEST_REPLICA_URLS",
+)
+
+
+@pytest.fixture
+def app(monkeypatch):
+    monkeypatch.setenv("APP_SETTINGS", "src.config.TestingConfig")
+    from src import create_app, db
+    from src.replicas import replica_lag
+
+    app = create_app()
+    # route to the replica whatever its lag, so the tests don't depend on it
+    app.config["REPLICA_MAX_LAG"] = float("inf")
+    replica_lag.clear()
+    with app.app_context():
+        yield app
+        db.session.rollback()
+        db.session.remove()
+
+
+@pytest.fixture
+def engines(app):
+    from src import db
+    from src.replicas import replica_bind_names
+
+    return db.get_engine(app), db.get_engine(app, bind=replica_bind_names(app)[0])
+
+
+def bind_in_replica_scope(statement):
+    from src import db
+    from src.replicas import replica_reads
+
+    @replica_reads
+    def get_bind():
+        return db.session.get_bind(clause=text(statement))
+
+    return get_bind()
+
+
+def test_text_select_reads_from_replica(engines):
+    from src import db
+
+    primary, replica = engines
+    assert bind_in_replica_scope("SELECT 1") is replica
+    assert not db.session().wrote
+
+
+@pytest.mark.parametrize(
+    "statement",
+    [
+        "INSERT INTO places (name) VALUES ('x')",
+        "\n  update places SET name = 'x'",
+        "DELETE FROM places",
+        "WITH moved AS (DELETE FROM places RETURNING *) SELECT count(*) FROM moved",
+        "SELECT id FROM places FOR UPDATE",
+        "CREATE TEMP TABLE scratch (n integer)",
+        "ANALYZE places",
+    ],
+)
+def test_text_dml_goes_to_primary(engines, statement):
+    from src import db
+
+    primary, replica = engines
+    assert bind_in_replica_scope(statement) is primary
+    assert db.session().wrote
+    # and so does everything after it
+    assert bind_in_replica_scope("SELECT 1") is primary
+
+
+def test_text_write_is_visible_to_later_reads(app):
+    from src import db
+    from src.replicas import replica_reads
+
+    @replica_reads
+    def write_and_read():
+        db.session.execute(text("CREATE TEMP TABLE scratch (n integer) ON COMMIT DROP"))
+        db.session.execute(text("INSERT INTO scratch (n) VALUES (1)"))
+        return db.session.execute(text("SELECT n FROM scratch")).scalar()
+
+    assert write_and_read() == 1
+    # the temp table only exists on the connection that created it
+    assert db.session.execute(text("SELECT n FROM scratch")).scalar() == 1
+
+
+def test_primary_reads_inside_replica_reads(engines):
+    from src import db
+    from src.replicas import primary_reads, replica_reads
+
+    primary, replica = engines
+
+    @primary_reads
+    def load():
+        return db.session.get_bind(clause=text("SELECT 1"))
+
+    @replica_reads
+    def search():
+        return load(), db.session.get_bind(clause=text("SELECT 1"))
+
+    assert search() == (primary, replica)
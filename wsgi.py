@@ -0,0 +1,6 @@
+"""WSGI entry point for production: `gunicorn --config gunicorn.conf.py wsgi:app`.
+
+Builds the app once and imports nothing the CLI (manage.py) needs."""
+from src import create_app
+
+app = create_app()